@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+from dnd.char_sheet.errors import FormulaError
+from dnd.char_sheet.systems.pathfinder import Pathfinder
+
+# @param c (Character)
+# @return (dict) everything a batch can change
+def state(c):
+  return {
+    'stats': {n: (s.value, s.normal, s.formula) for (n, s) in c.stats.items()},
+    'bonuses': {n: (b.value, b.active, sorted(b.effects))
+        for (n, b) in c.bonuses.items()},
+    'effects': {n: str(e) for (n, e) in c.effects.items()},
+    'texts': {n: t.text for (n, t) in c.texts.items()},
+  }
+
+def new_char():
+  return Pathfinder(output_func=lambda *args: None)
+
+# @param c (Character) a bit of everything that can go in a batch
+def changes(c):
+
+  c.set_stat('dexterity', formula='18')
+  c.add_bonus('belt', '2', 'dexterity', typ='enhancement')
+  c.add_bonus('mage', '4', 'ac', typ='armor')
+  c.set_stat('level', formula='6')
+  c.skill('rank', None, 3)
+  c.skill('class', 'acrobatics')
+  c.off('mage')
+  c.add_stat('custom', '$dex*2')
+  c.set_text('name', 'bob')
+  c.add_effect('haste', ['mage'], '3')
+  c.advance(2)
+  c.set_bonus('belt', formula='4')
+  c.del_bonus('belt')
+
+def test_same_as_unbatched():
+
+  (a, b) = (new_char(), new_char())
+  changes(a)
+  with b.batch():
+    changes(b)
+  assert state(a) == state(b)
+
+def test_recalc_deferred():
+
+  c = new_char()
+  dex = c.stats['dex'].value
+  with c.batch():
+    c.set_stat('dexterity', formula='20')
+    assert c.stats['dexterity'].value == 20
+    assert c.stats['dex'].value == dex
+  assert c.stats['dex'].value == 5
+
+def test_rollback():
+
+  c = new_char()
+  before = state(c)
+  try:
+    with c.batch():
+      changes(c)
+      c.set_stat('strength', formula='$nope+')
+  except FormulaError:
+    pass
+  else:
+    assert False, 'no FormulaError'
+  assert state(c) == before
+
+def test_nested_rollback():
+
+  c = new_char()
+  with c.batch():
+    c.set_stat('dexterity', formula='18')
+    try:
+      with c.batch():
+        c.set_stat('level', formula='9')
+        c.add_stat('bad', '$$$')
+    except FormulaError:
+      pass
+  assert c.stats['dexterity'].value == 18
+  assert c.stats['dex'].value == 4
+  assert c.stats['level'].value == 1
+  assert 'bad' not in c.stats
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import struct
+import zlib
+
+from dnd.char_sheet import binary
+from dnd.char_sheet.char import Character
+
+# @param c (Character)
+# @return (dict) everything a saved character should keep
+def state(c):
+  return {
+    'stats': {n: (s.value, s.normal, s.formula) for (n, s) in c.stats.items()},
+    'bonuses': {n: (b.value, b.active, b.typ, sorted(b.stats))
+        for (n, b) in c.bonuses.items()},
+    'effects': {n: str(e) for (n, e) in c.effects.items()},
+    'texts': {n: t.text for (n, t) in c.texts.items()},
+  }
+
+def new_char():
+
+  c = Character.new('pathfinder', output_func=lambda *args: None)
+  c.set_stat('dexterity', formula='17')
+  c.add_stat('custom', '$dex*2+$level')
+  c.add_bonus('belt', '2', 'dexterity', 'enhancement')
+  c.add_bonus('dodgy', '1+$level', 'ac', 'dodge', cond='when dodging')
+  c.add_effect('haste', ['belt', 'dodgy'], '3')
+  c.add_text('notes', 'hello')
+  return c
+
+# @param fname (str)
+# @return (Character)
+def load(fname):
+
+  (c, errors) = Character.load(fname, output_func=lambda *args: None)
+  assert not errors, errors
+  return c
+
+def test_round_trip(tmp_path):
+
+  c = new_char()
+  (txt, chb) = (str(tmp_path / 'c.txt'), str(tmp_path / 'c.chb'))
+  c.save(txt)
+  from_text = state(load(txt))
+
+  for code in (True, False):
+    c.save(chb, code=code)
+    loaded = load(chb)
+    assert state(loaded) == from_text
+
+    # and back to text again
+    loaded.save(txt)
+    assert state(load(txt)) == from_text
+
+def test_code_section():
+
+  c = new_char()
+  stats = [r for r in binary.loads(binary.dumps(c))[1] if r[3]]
+  assert stats and all(r[3][2] is not None for r in stats)
+  stats = [r for r in binary.loads(binary.dumps(c, code=False))[1] if r[3]]
+  assert stats and all(r[3][2] is None for r in stats)
+
+  # compiled code from another python version is skipped, not used
+  data = binary.dumps(c)
+  data = data[:10] + b'\0\0\0\0' + data[14:]
+  assert all(r[3][2] is None for r in binary.loads(data)[1] if r[3])
+
+# @param data (bytes) a file as written by dumps()
+# @return (list of 2-tuple) tag and contents of each section
+def sections(data):
+
+  body = zlib.decompress(data[binary.HEADER.size:])
+  out = []
+  pos = 0
+  while pos < len(body):
+    (tag, size) = binary.SECTION.unpack_from(body, pos)
+    pos += binary.SECTION.size
+    out.append((tag, body[pos:pos + size]))
+    pos += size
+  return out
+
+# @param data (bytes) a file as written by dumps()
+# @param sections (list of 2-tuple) see sections()
+# @return (bytes) the file with its sections replaced
+def rebuild(data, sections):
+
+  body = b''.join(binary.SECTION.pack(t, len(s)) + s for (t, s) in sections)
+  return data[:binary.HEADER.size] + zlib.compress(body)
+
+def test_bad_data():
+
+  data = binary.dumps(new_char())
+  parts = sections(data)
+  bad = [
+    data[:5],
+    b'NOTACHAR' + data[8:],
+    data[:8] + struct.pack('<H', binary.VERSION + 1) + data[10:],
+    data[:-10],
+    data[:binary.HEADER.size] + b'garbage',
+    rebuild(data, [(t, s + b'\0' if t == b'RECS' else s) for (t, s) in parts]),
+    rebuild(data, [p for p in parts if p[0] != b'FLDS']),
+    rebuild(data, [(t, b'\xff' * len(s) if t == b'FLDS' else s)
+        for (t, s) in parts]),
+    rebuild(data, [(t, s[:len(s) // 2] if t == b'CODE' else s)
+        for (t, s) in parts]),
+    data[:binary.HEADER.size] + zlib.compress(b'STRS\xff\xff\xff\xff'),
+  ]
+  for (i, d) in enumerate(bad):
+    try:
+      binary.loads(d)
+    except ValueError:
+      continue
+    assert False, 'case %s loaded' % i
+
+def test_load_reports_bad_data(tmp_path):
+
+  fname = str(tmp_path / 'c.chb')
+  new_char().save(fname)
+  with open(fname, 'rb') as f:
+    data = f.read()
+  with open(fname, 'wb') as f:
+    f.write(data[:-10])
+  (c, errors) = Character.load(fname, output_func=lambda *args: None)
+  assert c is None and errors
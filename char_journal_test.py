@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import os
+
+from dnd.char_sheet.char import Character
+from dnd.char_sheet.cli import CLI
+from dnd.char_sheet.journal import Journal
+
+COMMANDS = [
+  'set stat dexterity formula=18',
+  'add bonus belt 2 dexterity enhancement',
+  'add effect haste belt 3',
+  'advance 2',
+  'dmg 7',
+  'skill rank acrobatics 1',
+  'add stat custom $dex*2',
+  'set text name bob',
+]
+
+# @param c (Character)
+# @return (dict) what a reloaded character should have
+def state(c):
+  return {
+    'stats': {n: (s.value, s.normal) for (n, s) in c.stats.items()},
+    'bonuses': {n: (b.value, b.active) for (n, b) in c.bonuses.items()},
+    'effects': {n: str(e) for (n, e) in c.effects.items()},
+    'texts': {n: t.text for (n, t) in c.texts.items()},
+  }
+
+# @param fname (str)
+# @return (CLI) with a new character saved to fname and journaling
+def new_cli(fname):
+
+  cli = CLI(journal=True)
+  cli.output = lambda *args: None
+  run(cli, 'new')
+  cli.save(fname)
+  return cli
+
+# @param cli (CLI)
+# @param line (str) command to run like the prompt would
+def run(cli, line):
+
+  cli.onecmd(line)
+  cli.postcmd(False, line)
+
+# @param fname (str)
+# @return (dict) state() of the character loaded from fname
+def reload(fname):
+
+  (c, errors) = Character.load(fname, output_func=lambda *args: None)
+  assert not errors, errors
+  return state(c)
+
+def read(fname):
+  with open(fname, 'rb') as f:
+    return f.read()
+
+def test_append_and_replay(tmp_path):
+  for ext in ('.txt', '.chb'):
+    fname = str(tmp_path / ('char' + ext))
+    cli = new_cli(fname)
+    snapshot = read(fname)
+    for line in COMMANDS:
+      run(cli, line)
+
+    # every command went to the journal instead of the snapshot
+    assert read(fname) == snapshot
+    with open(fname + Journal.EXT) as f:
+      lines = [x for x in f.read().split('\n') if x]
+    assert lines[0] == Journal.header(snapshot)
+    assert len(lines) == len(COMMANDS) + 1
+    assert reload(fname) == state(cli.char)
+
+def test_compact_at_limit(tmp_path):
+
+  fname = str(tmp_path / 'char.txt')
+  cli = new_cli(fname)
+  snapshot = read(fname)
+  cli.journal.limit = 3
+  for line in COMMANDS:
+    run(cli, line)
+
+  assert read(fname) != snapshot
+  assert cli.journal.records <= 3
+  assert reload(fname) == state(cli.char)
+
+def test_compact_on_unjournaled_command(tmp_path):
+
+  fname = str(tmp_path / 'char.txt')
+  cli = new_cli(fname)
+  for line in COMMANDS[:3]:
+    run(cli, line)
+  run(cli, 'undo')
+
+  assert cli.journal.records == 0
+  with open(fname + Journal.EXT) as f:
+    assert f.read() == Journal.header(read(fname)) + '\n'
+  assert reload(fname) == state(cli.char)
+
+def test_truncated_last_record(tmp_path):
+
+  fname = str(tmp_path / 'char.txt')
+  cli = new_cli(fname)
+  for line in COMMANDS[:2]:
+    run(cli, line)
+  expected = state(cli.char)
+  run(cli, COMMANDS[2])
+
+  # as if we crashed halfway through writing the last record
+  path = fname + Journal.EXT
+  with open(path) as f:
+    text = f.read()
+  with open(path, 'w') as f:
+    f.write(text[:-10])
+  assert reload(fname) == expected
+
+def test_stale_journal_ignored(tmp_path):
+
+  fname = str(tmp_path / 'char.txt')
+  cli = new_cli(fname)
+  for line in COMMANDS:
+    run(cli, line)
+
+  # a different snapshot than the one the journal was written for
+  other = Character.new('pathfinder', output_func=lambda *args: None)
+  other.set_stat('strength', formula='7')
+  other.save(fname)
+  assert os.path.getsize(fname + Journal.EXT)
+  assert reload(fname) == state(other)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+from dnd.char_sheet.systems.pathfinder import Pathfinder
+
+def new_char():
+
+  c = Pathfinder(output_func=lambda *args: None)
+  c.add_bonus('mage_armor', 4, '_ac_armor', 'armor')
+  c.add_bonus('shield', 4, '_ac_armor', 'armor', active=False)
+  c.add_bonus('cats', 4, 'dexterity', 'enhancement', active=False)
+  c.add_bonus('dodge', 1, '_ac_dex', 'dodge')
+  c.add_bonus('hat', 2, 'melee', 'none', cond='vs giants')
+  c.add_bonus('insp', '1+int($dex/2)', 'melee', 'morale', active=False)
+  c.add_effect('haste', ['dodge'])
+  return c
+
+# @param c (Character)
+# @return (dict) name:value for every stat
+def values(c):
+  return {n: s.value for (n, s) in c.stats.items()}
+
+# @param c (Character)
+# @param name (str) bonus or effect
+# @param active (bool)
+def toggle(c, name, active):
+
+  names = c.effects[name].bonuses if name in c.effects else [name]
+  for b in names:
+    if active:
+      c.bonuses[b].on()
+    else:
+      c.bonuses[b].off(force=True)
+
+CASES = [
+  (['cats'], []),
+  (['shield'], ['mage_armor']),
+  (['insp', 'cats', 'hat'], ['haste']),
+  ([], ['cats', 'insp']),
+]
+
+def test_what_if_matches_toggling():
+
+  for (on, off) in CASES:
+    c = new_char()
+    before = values(c)
+    overlay = c.what_if(on=on, off=off)
+    predicted = {n: overlay.value(s) for (n, s) in c.stats.items()}
+    assert values(c) == before
+
+    for name in on:
+      toggle(c, name, True)
+    for name in off:
+      toggle(c, name, False)
+    assert predicted == values(c), (on, off)
+
+def test_overlays_are_independent():
+
+  c = new_char()
+  ac = c.stats['ac'].value
+  (a, b) = (c.what_if(on='shield'), c.what_if(off='mage_armor'))
+  assert a.value(c.stats['ac']) == ac
+  assert b.value(c.stats['ac']) == ac - 4
+  assert c.stats['ac'].value == ac
+
+def test_get_with_without():
+
+  c = new_char()
+  ac = c.stats['ac'].value
+  assert ('%s ac (without mage_armor, was %s)' % (ac - 4, ac)
+      in c.get('stat', 'ac', 'without', 'mage_armor'))
+  assert c.stats['ac'].value == ac
+  for (mode, bonus) in (('sideways', 'cats'), ('with', 'nope')):
+    try:
+      c.get('stat', 'ac', mode, bonus)
+    except (KeyError, ValueError):
+      continue
+    assert False, mode
+
+def conditional_char():
+
+  c = Pathfinder(output_func=lambda *args: None)
+  c.add_bonus('def_tr', 4, 'ac', 'dodge', cond='vs giants')
+  c.add_bonus('flank', 2, 'melee', 'none', cond='flanking')
+  c.add_bonus('hat', 1, ['melee', 'ranged'], 'none', cond='vs orcs')
+  c.add_bonus('sh', 2, '_ac_armor', 'shield', cond='behind cover')
+  c.add_bonus('morale', '1+int($melee/2)', 'dexterity', 'morale',
+      cond='raging')
+  c.bonuses['hat'].on()
+  return c
+
+# @param table (str) output of Character.conditions()
+# @return (2-tuple) the bonus names and a mask:value dict
+def parse(table):
+
+  lines = table.split('\n')
+  names = [x.strip() for x in lines[0].split('|')[1:]]
+  rows = {}
+  for line in lines[1:]:
+    cells = [x.strip() for x in line.split('|')]
+    mask = sum(1 << i for (i, x) in enumerate(cells[1:]) if x == '+')
+    rows[mask] = int(cells[0])
+  return (names, rows)
+
+def test_conditions_match_toggling():
+
+  for (stat, bonuses) in (('ac', None), ('melee', None),
+      ('ac', ['def_tr', 'morale', 'sh', 'hat'])):
+    c = conditional_char()
+    before = values(c)
+    (names, rows) = parse(c.conditions(stat, bonuses))
+    assert values(c) == before
+    assert len(rows) == 2 ** len(names)
+    if bonuses:
+      assert names == bonuses
+
+    for (mask, value) in rows.items():
+      for (i, name) in enumerate(names):
+        c.bonuses[name].toggle(bool(mask >> i & 1))
+      assert c.stats[stat].value == value, (stat, mask)
+
+def test_conditions_limits():
+
+  c = conditional_char()
+  assert c.conditions('xp') == 'no conditional bonuses for stat "xp"'
+  try:
+    c.conditions('ac', ['b%s' % i for i in range(c.CONDITIONS + 1)])
+  except ValueError:
+    pass
+  else:
+    assert False, 'too many bonuses allowed'
+  try:
+    c.conditions('nope')
+  except KeyError:
+    pass
+  else:
+    assert False, 'unknown stat allowed'
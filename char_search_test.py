@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+from dnd.char_sheet.names import NameIndex
+from dnd.char_sheet.systems.pathfinder import Pathfinder
+
+def new_char():
+
+  c = Pathfinder(output_func=lambda *args: None)
+  c.track_changes()
+  return c
+
+def test_name_index():
+
+  index = NameIndex(['Dexterity', 'dex', 'index', 'ac'])
+  assert index.find('dex') == ['dex', 'index']
+  assert index.find('') == ['Dexterity', 'dex', 'index', 'ac']
+  assert index.find('x') == ['Dexterity', 'dex', 'index']
+  assert index.find('zz') == []
+  index = NameIndex(['Dexterity', 'dex', 'index', 'ac'], ignore_case=True)
+  assert index.find('DEX') == ['Dexterity', 'dex', 'index']
+
+def test_plain_same_as_regex():
+
+  c = new_char()
+  for name in ('dex', 'ac', 'a', 'skill', 'zzz'):
+    for case in (True, False):
+      for fields in (None, 'stat', ['bonus', 'effect']):
+        assert (c.search(name, fields=fields, ignore_case=case) ==
+            c.search('(%s)' % name, fields=fields, ignore_case=case))
+
+def test_index_follows_changes():
+
+  c = new_char()
+  assert c.search('zzz') == ''
+
+  c.add_stat('zzz_stat', '1')
+  c.checkpoint()
+  assert c.search('zzz', fields='stat') != ''
+  c.add_bonus('zzz_bonus', '1', 'zzz_stat')
+  c.checkpoint()
+  assert c.search('ZZZ', fields='bonus') != ''
+  assert c.search('ZZZ', fields='bonus', ignore_case=False) == ''
+
+  c.del_bonus('zzz_bonus')
+  c.checkpoint()
+  assert c.search('zzz', fields='bonus') == ''
+  c.undo()
+  assert c.search('zzz', fields='bonus') != ''
+  c.undo(2)
+  assert c.search('zzz') == ''
+  c.redo()
+  assert c.search('zzz', fields='stat') != ''
+  assert c.search('zzz', fields='bonus') == ''
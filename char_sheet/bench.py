@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+#
+# micro-benchmarks for character sheets
+#
+# usage: ./bench.py [benchmark ...]
+#   runs every benchmark if none are named
+#
+# ROOTS = ['dexterity', 'strength', 'constitution', 'wisdom', 'level', 'size']
+# the stats to change on a full Pathfinder sheet
+#
+# RUNS = 200
+# number of changes per timing
+#
+# FIELDS = 5000
+# size of the character used to compare save formats
+#
+# DIAMOND = (4, 6)
+# width and depth of the layers of stats added for the diamond recalc case
+
+import os,sys,tempfile,time
+
+import environ
+from dnd.char_sheet import binary
+from dnd.char_sheet.char import Character
+from dnd.char_sheet.systems.pathfinder import Pathfinder
+
+ROOTS = ['dexterity', 'strength', 'constitution', 'wisdom', 'level', 'size']
+RUNS = 200
+FIELDS = 5000
+DIAMOND = (4, 6)
+
+def main(args):
+
+  names = args or [x[6:] for x in sorted(globals()) if x.startswith('bench_')]
+  for name in names:
+    print('===== %s\n' % name)
+    globals()['bench_' + name]()
+    print('')
+
+# @return (Pathfinder) a full sheet that doesn't print anything
+def new_char():
+  return Pathfinder(output_func=lambda *args: None)
+
+# @return (Pathfinder) a full sheet padded out to FIELDS stats and bonuses
+#   with chains of stats that each have a bonus
+def big_char():
+
+  char = new_char()
+  n = (FIELDS - len(char.stats) - len(char.bonuses)) // 2
+  for i in range(n):
+    prev = '$dexterity' if i % 50 == 0 else '$bench_%s' % (i - 1)
+    char.add_stat('bench_%s' % i, '%s+%s' % (prev, i % 3))
+  for i in range(n):
+    typ = ('none', 'morale', 'luck')[i % 3]
+    char.add_bonus('bench_b%s' % i, '1+int($level/2)', 'bench_%s' % i, typ)
+  return char
+
+# @return (Pathfinder) a full sheet with layers of stats below dexterity
+#   where every stat uses every stat in the layer above, so each one can be
+#   reached from dexterity along many paths (see DIAMOND)
+def diamond_char():
+
+  char = new_char()
+  (width, depth) = DIAMOND
+  above = ['dexterity']
+  for layer in range(depth):
+    names = ['bench_%s_%s' % (layer, i) for i in range(width)]
+    for (i, name) in enumerate(names):
+      char.add_stat(name, '+'.join('$' + x for x in above) + '+%s' % i)
+    above = names
+  return char
+
+# how many calc() calls the old recursive bubbling made for one change if
+# every value along the way changed: one per path through the dependants
+# @param char (Character)
+# @param stat (Stat)
+# @return (int)
+def count_paths(char, stat):
+
+  paths = {stat: 1}
+  for field in char._topo([stat]):
+    for child in field._dependants():
+      paths[child] = paths.get(child, 0) + paths.get(field, 0)
+  return sum(paths.values())
+
+def bench_recalc():
+
+  print('%-14s %9s %9s %9s %9s' % (
+    'stat', 'affected', 'evals', 'paths', 'set us'))
+  # the full sheet barely has any stats reachable along more than one path
+  sheet = new_char()
+  cases = [(sheet, name, name) for name in ROOTS]
+  cases.append((diamond_char(), 'dexterity', 'diamond'))
+  for (char, name, label) in cases:
+    stat = char.stats[name]
+    affected = len(char._topo([stat]))
+    paths = count_paths(char, stat)
+    base = int(stat.original)
+
+    evals = char.evals
+    t = time.perf_counter()
+    for i in range(RUNS):
+      char.set_stat(name, formula=str(base + 2 * (i % 2 + 1)), force=True)
+    t = 1e6 * (time.perf_counter() - t) / RUNS
+    evals = (char.evals - evals) / RUNS
+
+    char.set_stat(name, formula=str(base), force=True)
+    print('%-14s %9s %9.1f %9s %9.1f' % (label, affected, evals, paths, t))
+
+def bench_load():
+
+  (fd, fname) = tempfile.mkstemp(suffix='.txt')
+  os.close(fd)
+  try:
+    new_char().save(fname)
+    totals = {}
+    for i in range(RUNS):
+      (char, errors) = Character.load(fname, output_func=lambda *args: None)
+      for (phase, t) in char.load_times.items():
+        totals[phase] = totals.get(phase, 0) + t
+  finally:
+    os.remove(fname)
+
+  print('%-14s %9s' % ('phase', 'ms'))
+  for (phase, t) in totals.items():
+    print('%-14s %9.2f' % (phase, 1e3 * t / RUNS))
+  print('%-14s %9.2f' % ('total', 1e3 * sum(totals.values()) / RUNS))
+
+def bench_formats():
+
+  char = big_char()
+  print('%d stats, %d bonuses\n' % (len(char.stats), len(char.bonuses)))
+  print('%-8s %9s %9s %9s %9s %9s' % (
+    'format', 'KiB', 'save ms', 'load ms', 'parse ms', 'compile'))
+  formats = (('txt', '.txt', False), ('chb', binary.EXT, True),
+      ('chb-code', binary.EXT, False))
+  for (label, ext, code) in formats:
+    (fd, fname) = tempfile.mkstemp(suffix=ext)
+    os.close(fd)
+    try:
+      t = time.perf_counter()
+      for i in range(RUNS // 20):
+        char.save(fname, code=code)
+      save = 1e3 * (time.perf_counter() - t) / (RUNS // 20)
+      size = os.path.getsize(fname) / 1024
+
+      t = time.perf_counter()
+      for i in range(RUNS // 20):
+        (loaded, errors) = Character.load(fname,
+            output_func=lambda *args: None)
+      load = 1e3 * (time.perf_counter() - t) / (RUNS // 20)
+    finally:
+      os.remove(fname)
+
+    times = loaded.load_times
+    print('%-8s %9.1f %9.1f %9.1f %9.1f %9.1f' % (label, size, save, load,
+        1e3 * times['parse'], 1e3 * times['compile']))
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
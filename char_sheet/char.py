@@ -1,6 +1,8 @@
 ##### COMMANDS #####
 
 # get (stat|bonus|text) NAME[,NAME...]
+# get stat NAME[,NAME...] (with|without) BONUS[,BONUS...]
+# conditions STAT [BONUS[,BONUS...]]
 # add stat NAME [FORMULA] [TEXT] [UPDATED]
 # add bonus NAME VALUE STAT[,STAT...] [TYP] [COND] [TEXT] [ACTIVE]
 # add text NAME TEXT
@@ -13,6 +15,8 @@
 # on BONUS
 # off BONUS
 # revert BONUS
+# undo [N]
+# redo [N]
 
 # dmg HPLOST
 # heal HPHEALED
@@ -25,7 +29,7 @@
 
 #    get : g     add : a    set : s      del : d        all : l      reset : r
 # search : ?      on : +    off : -   revert : v    advance : ++    create : c
-#   roll : !
+#   roll : !    undo : u
 #   stat : s   bonus : b   text : t   effect : e
 
 ##### EXAMPLES #####
@@ -73,7 +77,6 @@
 #   Text
 
 # ===== high-level / large-scale =====
-# [TODO] consider another way for set_stat() to interact with plug/unplug?
 # [TODO] decide what goes in here and what goes in the CLI
 # [TODO] stat classes for setting (and getting?) e.g. abilities, skills
 # [TODO] common effect library for importing: feats, spells, conditions
@@ -97,6 +100,7 @@
 
 import os,re,time,inspect
 import traceback
+from contextlib import contextmanager
 from functools import reduce
 from collections import OrderedDict
 from importlib import util as imp_util
@@ -105,7 +109,11 @@ from dnd.dice import Dice
 from dnd.duration import Duration
 from dnd.char_sheet.fields import *
 from dnd.char_sheet.errors import *
-from dnd.char_sheet.dec import arbargs
+from dnd.char_sheet.dec import arbargs,batched,journaled
+from dnd.char_sheet import binary as binfmt
+from dnd.char_sheet.journal import Journal
+from dnd.char_sheet.names import NameIndex
+from dnd.char_sheet.overlay import Overlay
 
 ###############################################################################
 # Universe class
@@ -142,6 +150,12 @@ class Character(object):
   # all bonuses stack
   BONUS_STACK = Universe()
 
+  # how many steps undo() can go back
+  UNDO = 100
+
+  # how many bonuses conditions() will combine (2**n combinations)
+  CONDITIONS = 10
+
   # @return (dict) name:class (str:class) pairs for each Field we know about
   @staticmethod
   def _get_fields():
@@ -195,6 +209,11 @@ class Character(object):
     return char
 
   # load a character from file
+  #   - text and binary files are told apart by the binary header
+  #   - commands in a journal next to the file are replayed afterwards
+  #   - every field is parsed before anything is added, then the stats and
+  #     bonuses are added all at once by _load()
+  #   - seconds spent in each phase end up in the character's load_times
   # @param name (str) file path
   # @param logger (logging.Logger) logger to use
   # @param input_func (func) used to format input prompts and return result
@@ -203,53 +222,164 @@ class Character(object):
   @staticmethod
   def load(name, logger=None, input_func=None, output_func=None):
 
-    with open(name,'r') as f:
-      lines = [x.strip(' \n') for x in f.readlines()]
+    start = time.perf_counter()
+    with open(name,'rb') as f:
+      data = f.read()
 
     errors = []
     (chars,fields) = Character._get_systems()
 
-    char = None
-    for (i,line) in enumerate(lines):
-      if not line or line.startswith('#'):
+    if binfmt.is_binary(data):
+      try:
+        (system,records) = binfmt.loads(data)
+      except ValueError as e:
+        errors.append(str(e))
+        return (None,errors)
+    else:
+      (system,records) = Character._parse(data.decode('utf8'))
+    if system not in chars:
+      errors.append('unknown character system "%s"' % system)
+      return (None,errors)
+
+    char = chars[system](setup=False, logger=logger,
+        input_func=input_func, output_func=output_func)
+    char.info('LOAD ' + char.__class__.__name__)
+
+    objs = []
+    for (i,typ,values,resolved) in records:
+      line = [typ]+values
+      if typ not in fields:
+        s = 'line %.4d | unknown object type "%s"' % (i+1,typ)
+        errors.append(s)
+        char.error(s)
         continue
-      if not char:
-        if line not in chars:
-          s = 'line %.4d | unknown character system "%s"' % (i+1,line)
-          errors.append(s)
-          char.error(s)
-          break
-        char = chars[line](setup=False, logger=logger,
-            input_func=input_func, output_func=output_func)
-        char.info('LOAD ' + char.__class__.__name__)
-      else:
-        line = line.split('\t')
-        if line[0] not in fields:
-          s = 'line %.4d | unknown object type "%s"' % (i+1,line[0])
-          errors.append(s)
-          char.error(s)
-          continue
-        try:
-          obj = fields[line[0]].load(line[1:])
-          if not errors:
-            char._get_add_method(obj.__class__)(obj)
-        except Exception as e:
-          lines = ['line %.4d |   %s' % (i+1,' / '.join(line))]
-          lines.append('*** %s: %s' % (e.__class__.__name__,e.args[0]))
-          for s in lines:
-            errors.append(s)
-            char.error(s)
-          char.debug(traceback.format_exc())
-
-    # add any new stats added since the character was saved
+      try:
+        obj = fields[typ].load(values)
+        if resolved:
+          obj._resolved = resolved
+        objs.append((i,line,obj))
+      except Exception as e:
+        errors += char._load_error(i,line,e)
+    char.load_times['parse'] = time.perf_counter()-start
+
+    if not errors:
+      errors = char._load(objs)
+    if not errors:
+      errors = Journal.replay(char,name,data)
     if not errors:
-      char._setup(ignore_dupes=True)
-      char.info('LOADED ' + char.text.get('name', 'None').text)
+      char.info('LOADED %s (%s)' % (char.text.get('name', 'None').text,
+          ', '.join('%s %.1fms' % (phase,1000*t)
+          for (phase,t) in char.load_times.items())))
     else:
       char.error('ERROR LOADING %s' % name)
 
     return (char,errors)
 
+  # split a text character file into records like binary.loads()
+  # @param text (str) file contents
+  # @return (2-tuple)
+  #   #0 (str) name of the Character class (None if there isn't one)
+  #   #1 (list of 4-tuple) line number, class name, values, None
+  @staticmethod
+  def _parse(text):
+
+    system = None
+    records = []
+    for (i,line) in enumerate(text.splitlines()):
+      line = line.strip(' \n')
+      if not line or line.startswith('#'):
+        continue
+      if system is None:
+        system = line
+      else:
+        line = line.split('\t')
+        records.append((i,line[0],line[1:],None))
+    return (system,records)
+
+  # add parsed fields in phases instead of one by one, so nothing is
+  # evaluated until every formula is in place and nothing is evaluated twice
+  #   - graph: put stats and bonuses in place so formulas can use any of them
+  #   - compile: plug them in without evaluating anything
+  #   - eval: evaluate each of them once in topological order
+  #   - setup: add everything else (e.g. effects) the normal way, then any
+  #     default fields the file was missing
+  # @param objs (list of 3-tuple) from load()
+  #   #0 (int) line number
+  #   #1 (list of str) the split line
+  #   #2 (Field) the parsed field
+  # @return (list of str) errors
+  def _load(self,objs):
+
+    errors = []
+    times = self.load_times
+    stats = [x for x in objs if isinstance(x[2],Stat)]
+    others = [x for x in objs if not isinstance(x[2],Stat)]
+
+    start = time.perf_counter()
+    for (i,line,obj) in stats:
+      typ = self._get_typ(obj.__class__)
+      fields = getattr(self,typ)
+      if obj.name in fields:
+        e = DuplicateError('%s "%s" already exists' % (typ,obj.name))
+        errors += self._load_error(i,line,e)
+      fields[obj.name] = obj
+    times['graph'] = time.perf_counter()-start
+    if errors:
+      return errors
+
+    start = time.perf_counter()
+    self._loading = True
+    try:
+      for (i,line,obj) in stats:
+        try:
+          obj.plug(self)
+        except Exception as e:
+          errors += self._load_error(i,line,e)
+    finally:
+      self._loading = False
+    times['compile'] = time.perf_counter()-start
+    if errors:
+      return errors
+
+    start = time.perf_counter()
+    lines = {obj:(i,line) for (i,line,obj) in stats}
+    for field in self._topo([x[2] for x in stats]):
+      self.evals += 1
+      try:
+        field._eval()
+      except Exception as e:
+        e = FormulaError('%s in "%s"' % (e.__class__.__name__,field.formula))
+        errors += self._load_error(*lines[field],e)
+    times['eval'] = time.perf_counter()-start
+    if errors:
+      return errors
+
+    start = time.perf_counter()
+    with self.batch():
+      for (i,line,obj) in others:
+        try:
+          self._get_add_method(obj.__class__)(obj)
+        except Exception as e:
+          errors += self._load_error(i,line,e)
+      if not errors:
+        self._setup(ignore_dupes=True)
+    times['setup'] = time.perf_counter()-start
+    return errors
+
+  # log a field that failed to load
+  # @param i (int) line number
+  # @param line (list of str) the split line
+  # @param e (Exception)
+  # @return (list of str) error lines
+  def _load_error(self,i,line,e):
+
+    lines = ['line %.4d |   %s' % (i+1,' / '.join(line))]
+    lines.append('*** %s: %s' % (e.__class__.__name__,e.args[0]))
+    for s in lines:
+      self.error(s)
+    self.debug(traceback.format_exc())
+    return lines
+
   # @param setup (bool) [True] pre-populate character
   # @param name (str) [None] character name (set to 'UNNAMED' if setup=True)
   # @param logger (logging.Logger) [None] logger to use
@@ -271,6 +401,33 @@ class Character(object):
     self.event = OrderedDict(); self.events = self.event
     self.text = OrderedDict(); self.texts = self.text
 
+    # how many _recalc() passes and single field evaluations have happened
+    self.recalcs = 0
+    self.evals = 0
+
+    # set to a Tracer to record what the stat engine does
+    self.tracer = None
+
+    # set while load() is adding fields, which then skip evaluating
+    # themselves, and how long each phase of load() took in seconds
+    self._loading = False
+    self.load_times = OrderedDict()
+
+    # inside batch(): fields waiting for the final recalc (a dict used as an
+    # ordered set) and a log of how to undo every change made so far
+    self._batch = None
+    self._changes = None
+
+    # after track_changes(): groups of logged changes that undo() and redo()
+    # walk through, and a count of every checkpoint() or undo/redo step that
+    # changed something so callers can tell if anything happened
+    self._undo = []
+    self._redo = []
+    self.revision = 0
+
+    # (type, ignore case):NameIndex pairs built by search() as needed
+    self._names = {}
+
     # aliases for objects
     self.letters = OrderedDict([
       ('s','stat'),
@@ -294,6 +451,9 @@ class Character(object):
       'reset',
       'expire',
       'roll',
+      'undo',
+      'redo',
+      'conditions',
     ]
 
     # register commands that have sub commands
@@ -315,6 +475,7 @@ class Character(object):
       'x' : 'expire',
       'c' : 'create',
       '!' : 'roll',
+      'u' : 'undo',
     }
 
     # register sub command aliases
@@ -333,16 +494,13 @@ class Character(object):
     for typ in self.letters.values():
       for suffix in ('S', 'ES'):
         fields = getattr(self, typ.upper() + suffix, {})
+        skip = fields.keys() & getattr(self, typ).keys() if ignore_dupes else ()
         for (name,args) in fields.items():
-          try:
-            if not isinstance(args, list):
-              args = [args]
-            getattr(self, 'add_' + typ)(name, *args)
-          except DuplicateError:
-            if ignore_dupes:
-              pass
-            else:
-              raise
+          if name in skip:
+            continue
+          if not isinstance(args, list):
+            args = [args]
+          getattr(self, 'add_' + typ)(name, *args)
 
     if self.name:
       self.set_text('name',self.name)
@@ -363,13 +521,19 @@ class Character(object):
   # @return (func) the relevant "add" method for adding Fields during file load
   # @raise KeyError
   def _get_add_method(self,cls):
+    return getattr(self,'_add_'+self._get_typ(cls))
+
+  # @param cls (class) a sub-class of Field
+  # @return (str) the type of field it is e.g. "stat" for a PathfinderSkill
+  # @raise KeyError
+  def _get_typ(self,cls):
 
     if cls.__name__.lower() in self.letters.values():
-      return getattr(self,'_add_'+cls.__name__.lower())
+      return cls.__name__.lower()
 
     # handle sub classes
     if cls.__bases__:
-      return self._get_add_method(cls.__bases__[0])
+      return self._get_typ(cls.__bases__[0])
 
     raise KeyError('failed to get add method')
 
@@ -378,17 +542,269 @@ class Character(object):
   def _stacks(self,typ):
     return not self.BONUS_STACK or typ in self.BONUS_STACK
 
+  # recalculate some fields and everything downstream of them in one pass
+  #   - the affected subgraph is put in topological order so every field is
+  #     evaluated at most once, after everything it uses
+  #   - fields passed in are always evaluated, others only if something they
+  #     use actually changed
+  #   - cycles (e.g. a bonus on a stat its own formula uses) are cut where the
+  #     walk first loops back, so the field that started it isn't redone
+  # @param fields (list of Stat) fields that need recalculating
+  def _recalc(self,fields):
+
+    self.recalcs += 1
+    tracer = self.tracer
+
+    # inside a batch only the fields themselves are brought up to date and
+    # everything downstream waits for the single pass at the end
+    if self._batch is not None:
+      for field in fields:
+        self._batch[field] = None
+        self.evals += 1
+        if tracer is None:
+          field._eval()
+        else:
+          tracer.calc(field)
+      return
+
+    # dirty fields mapped to the field that made them dirty, if any
+    dirty = dict.fromkeys(fields)
+    for field in self._topo(fields):
+      if field in dirty:
+        self.evals += 1
+        if tracer is None:
+          changed = field._eval()
+        else:
+          changed = tracer.calc(field, dirty[field])
+        if changed:
+          for child in field._dependants():
+            dirty.setdefault(child, field)
+
+  # @param fields (list of Stat)
+  # @return (list of Stat) fields and all their dependants, each after every
+  #   field it depends on
+  def _topo(self,fields):
+
+    # iterative depth first search so long chains can't hit the recursion limit
+    seen = set()
+    order = []
+    for root in fields:
+      if root in seen:
+        continue
+      seen.add(root)
+      stack = [(root,iter(root._dependants()))]
+      while stack:
+        (field,children) = stack[-1]
+        for child in children:
+          if child not in seen:
+            seen.add(child)
+            stack.append((child,iter(child._dependants())))
+            break
+        else:
+          stack.pop()
+          order.append(field)
+    order.reverse()
+    return order
+
+  # make a group of changes that is recalculated once at the end and rolled
+  # back entirely if any of them fails with a FormulaError
+  #   - fields are still evaluated when they're changed, but their dependants
+  #     aren't, so values downstream of a change are stale until we exit
+  #   - nested batches join the outer one, but roll back only their own changes
+  # @raise FormulaError after rolling back
+  @contextmanager
+  def batch(self):
+
+    outer = self._batch is not None
+    if not outer:
+      self._batch = {}
+    logging = self._changes is None
+    if logging:
+      self._changes = []
+    mark = len(self._changes)
+
+    try:
+      yield self
+    except FormulaError:
+      self._rollback(mark)
+      raise
+    finally:
+      if logging:
+        self._changes = None
+      # the fields themselves are already up to date but nothing using them is
+      if not outer:
+        fields = [f for f in self._batch if f.char is self]
+        self._batch = None
+        self._recalc([x for f in fields for x in f._dependants()])
+
+  # record that a field was added, replaced or deleted
+  # @param typ (str) e.g. "stats"
+  # @param name (str)
+  # @param old (Field) what used to be there or None if nothing was
+  def _changed(self,typ,name,old):
+
+    if old is None or name not in getattr(self,typ):
+      self._unindex(typ)
+    if self._changes is not None:
+      self._changes.append(('put',typ,name,old))
+
+  # record attributes of a field that are about to be changed in place
+  # @param field (Field)
+  # @param attrs (list of str) attribute names
+  def _remember(self,field,*attrs):
+
+    if self._changes is not None:
+      old = {}
+      for attr in attrs:
+        val = getattr(field,attr)
+        old[attr] = val.copy() if isinstance(val,Duration) else val
+      self._changes.append(('attrs',field,old))
+
+  # undo every change recorded since a point in the log, newest first
+  # @param mark (int) length of the log at that point
+  def _rollback(self,mark):
+
+    changes = self._changes
+    self._changes = None
+    try:
+      while len(changes)>mark:
+        self._revert(changes.pop())
+    finally:
+      self._changes = changes
+
+  # apply one entry of the change log
+  # @param change (tuple) see _changed() and _remember()
+  # @return (tuple) the entry that would undo this
+  def _revert(self,change):
+
+    if change[0]=='put':
+      (_,typ,name,field) = change
+      current = getattr(self,typ).get(name)
+      self._put(typ,name,field)
+      return ('put',typ,name,current)
+
+    (_,field,attrs) = change
+    current = {attr:getattr(field,attr) for attr in attrs}
+    field._restore(attrs)
+    return ('attrs',field,current)
+
+  # apply a group of changes newest first and recalculate once at the end
+  # @param changes (list of tuple)
+  # @return (list of tuple) the group that would undo this
+  def _revert_all(self,changes):
+
+    saved = self._changes
+    self._changes = None
+    try:
+      with self.batch():
+        return [self._revert(change) for change in reversed(changes)]
+    finally:
+      self._changes = saved
+
+  # swap the field stored under a name without any checks, keeping track of
+  # stats that use the old one
+  # @param typ (str) e.g. "stats"
+  # @param name (str)
+  # @param field (Field) the field to put there or None to delete it
+  def _put(self,typ,name,field):
+
+    fields = getattr(self,typ)
+    old = fields.get(name)
+    if old is field:
+      return
+    if old is None or field is None:
+      self._unindex(typ)
+
+    # (un)plugging an effect toggles its bonuses, but the state they should
+    # be in is already somewhere else in the change log, so put them back
+    saved = {}
+    if typ=='effects':
+      names = [b for e in (old,field) if e is not None for b in e.bonuses]
+      for bonus in [self.bonuses[b] for b in names if b in self.bonuses]:
+        saved[bonus] = {'active':bonus.active,'last':bonus.last}
+
+    if old is not None:
+      if field is not None and isinstance(old,Stat):
+        field.usedby = old.usedby
+        field.leaf = not old.usedby
+      if isinstance(old,Stat):
+        old.unplug(force=True)
+      elif typ!='texts':
+        old.unplug()
+      # a replacement keeps its place
+      if field is None:
+        del fields[name]
+
+    if field is not None:
+      fields[name] = field
+      if typ!='texts':
+        field.plug(self)
+
+    for (bonus,attrs) in saved.items():
+      if (bonus.active,bonus.last)!=(attrs['active'],attrs['last']):
+        bonus._restore(attrs)
+
+  # start recording changes so they can be undone, see checkpoint()
+  def track_changes(self):
+
+    if self._changes is None:
+      self._changes = []
+
+  # finish a step for undo() out of everything changed since the last call
+  #   - only the fields that changed are kept, not copies of the character
+  #   - making a new step throws away anything that could be redone
+  # @return (bool) if anything changed
+  def checkpoint(self):
+
+    if not self._changes:
+      return False
+    self._undo.append(self._changes)
+    del self._undo[:-self.UNDO]
+    self._redo = []
+    self._changes = []
+    self.revision += 1
+    return True
+
+  # move steps from one history to the other, applying them on the way
+  # @param src (list) steps to apply, newest last
+  # @param dst (list) where to put the steps that reverse them
+  # @param n (int) how many
+  # @param what (str) for the error message
+  # @raise ValueError if changes aren't being tracked or there's nothing to do
+  def _step(self,src,dst,n,what):
+
+    if self._changes is None:
+      raise ValueError('changes are not being tracked')
+    self.checkpoint()
+    if not src:
+      raise ValueError('nothing to %s' % what)
+    for i in range(min(int(n),len(src))):
+      dst.append(self._revert_all(src.pop()))
+      self.revision += 1
+
   # save this character
   # @param name (str) file path
-  def save(self,name):
-
-    s = self.__class__.__name__+'\n'
+  # @param binary (bool) [None] use the binary format instead of text (None
+  #   picks it by the file extension, see binary.EXT)
+  # @param code (bool) [True] also store compiled formulas in binary files so
+  #   they load faster, see binary.dumps()
+  def save(self, name, binary=None, code=True):
+
+    if binary is None:
+      binary = name.endswith(binfmt.EXT)
+    if binary:
+      with open(name,'wb') as f:
+        f.write(binfmt.dumps(self,code=code))
+      return
+
+    lines = [self.__class__.__name__]
     for typ in self.letters.values():
       for obj in getattr(self,typ).values():
-        s += ('%s\t' % obj.__class__.__name__)+'\t'.join(obj.save())+'\n'
+        lines.append('\t'.join([obj.__class__.__name__]+obj.save()))
+    lines.append('')
 
     with open(name,'w') as f:
-      f.write(s)
+      f.write('\n'.join(lines))
 
   # log things
   def info(self, s):
@@ -525,8 +941,12 @@ class Character(object):
     """
     roll some dice; if the first argument is a valid stat or list:
       - stat (string,list) the stat(s) to roll
+      - [dice = "d20"] (string) what to roll e.g. "2d20kh1" for advantage
     otherwisethe args are a dice string and we roll that:
       - dice (string) e.g. "d20" "4d6" "3d6+1d4+2"
+      - keep/drop: "4d6kh3" "4d6dl1" "2d20kl1" (kh,kl,dh,dl)
+      - reroll once: "1d20r1" "2d6r1r2"
+      - explode (roll again on max): "1d6!"
     """
 
     stats = None
@@ -536,6 +956,7 @@ class Character(object):
       stats = [args[0]]
     else:
       return NotImplemented
+    dice = Dice(''.join(args[1:]) or 'd20')
 
     pad = len(max(stats,key=len))
     for name in stats:
@@ -546,7 +967,7 @@ class Character(object):
       except KeyError:
         s += 'KeyError'
       except AttributeError:
-        s += str(Dice('d20').roll()+stat.value)
+        s += str(dice.roll()+stat.value)
       self.output(s)
 
   @arbargs
@@ -583,44 +1004,96 @@ class Character(object):
       if field not in self.letters.values():
         raise ValueError('unknown field type "%s"' % field)
 
-    attrs = {
-        attr: (s if '@' in s else re.compile(s,case))
-        for (attr,s) in kwargs.items()
-    }
+    # plain names are looked up in an index instead of matching every name
+    plain = re.escape(name)==name
+    r = None if plain else re.compile(name,case)
+    test = self._search_filter(kwargs,case,include_missing)
 
-    r = re.compile(name,case)
     matches = []
     for (l,d) in self.letters.items():
       if d not in fields:
         continue
-      for (n,obj) in getattr(self,d).items():
-        if r.search(n) and (exclude=='*' or not n.startswith(exclude)):
-          match = True
-          for (name,key) in attrs.items():
-            if hasattr(obj,name):
-              attr = getattr(obj,name)
-              if callable(attr) and name.startswith('is_'):
-                attr = attr()
-              if isinstance(key,str):
-                if not eval(key.replace('@','attr')):
-                  match=False
-                  break
-              elif not key.search(str(attr)):
-                match=False
-                break
-            elif not include_missing:
-              match = False
-              break
-          if match:
-            matches.append('%s | %s' % (l,obj.str_search()))
+      objs = getattr(self,d)
+      if plain:
+        names = self._name_index(d,ignore_case).find(name)
+      else:
+        names = [n for n in objs if r.search(n)]
+      for n in names:
+        if exclude!='*' and n.startswith(exclude):
+          continue
+        obj = objs[n]
+        if test(obj):
+          matches.append('%s | %s' % (l,obj.str_search()))
     return '\n'.join(matches)
 
+  # compile the attribute filters of a search into one function
+  #   - "@" expressions become functions once per search instead of being
+  #     parsed again for every object
+  #   - cheaper filters run first so most objects are rejected early:
+  #     expressions, then regexes, then anything calling an "is_" method
+  # @param kwargs (dict) attribute name to filter, see search()
+  # @param case (int) re flags
+  # @param include_missing (bool) objects without an attribute pass its filter
+  # @return (func) takes a Field and returns whether it passes every filter
+  @staticmethod
+  def _search_filter(kwargs,case,include_missing):
+
+    filters = []
+    for (name,s) in kwargs.items():
+      if '@' in s:
+        code = compile('lambda attr: (%s)' % s.replace('@','attr'),'<search>','eval')
+        (cost,func) = (0,eval(code))
+      else:
+        search = re.compile(s,case).search
+        (cost,func) = (1,lambda attr,search=search: search(str(attr)))
+      call = name.startswith('is_')
+      filters.append((cost+2*call,name,call,func))
+    filters.sort(key=lambda x:x[0])
+
+    def test(obj):
+      for (_,name,call,func) in filters:
+        try:
+          attr = getattr(obj,name)
+        except AttributeError:
+          if include_missing:
+            continue
+          return False
+        if call and callable(attr):
+          attr = attr()
+        if not func(attr):
+          return False
+      return True
+    return test
+
+  # @param typ (str) e.g. "stat"
+  # @param ignore_case (bool)
+  # @return (NameIndex) of the names of that type of field
+  def _name_index(self,typ,ignore_case):
+
+    key = (typ,ignore_case)
+    if key not in self._names:
+      self._names[key] = NameIndex(getattr(self,typ),ignore_case)
+    return self._names[key]
+
+  # forget the name indexes for a type of field after names were added or
+  # removed
+  # @param typ (str) e.g. "stats" or "stat"
+  def _unindex(self,typ):
+
+    fields = getattr(self,typ)
+    for key in [k for k in self._names if getattr(self,k[0]) is fields]:
+      del self._names[key]
+
   # @raise KeyError if typ does not exist
-  def get(self,typ,name):
+  # @raise ValueError if mode is invalid
+  def get(self,typ,name,mode=None,bonuses=None):
     """
     show a summary of the requested field(s)
       - typ (string) field type
       - name (string,list) the field name(s)
+      - [mode = None] (string) "with" or "without" to see what stat(s) would
+        be with some bonuses on or off, without actually toggling them
+      - [bonuses = None] (string,list) the bonus(es) or effect(s) for mode
     """
 
     typ = typ if typ not in self.letters else self.letters[typ]
@@ -632,14 +1105,44 @@ class Character(object):
     elif not isinstance(name,list):
       name = [name]
 
+    overlay = None
+    if mode is not None:
+      if mode not in ('with','without'):
+        raise ValueError('expected "with" or "without" but got "%s"' % mode)
+      if typ!='stat':
+        raise ValueError('"%s" only works for stats' % mode)
+      if not isinstance(bonuses,list):
+        bonuses = [bonuses]
+      overlay = self.what_if(**{('off','on')[mode=='with']:bonuses})
+
     results = []
     for n in name:
       try:
-        results.append(str(getattr(self,typ)[n]))
+        field = getattr(self,typ)[n]
+        if overlay is None:
+          results.append(str(field))
+        else:
+          results.append('%s %3s %s (%s %s, was %s)' % (field._str_flags(),
+              overlay.value(field),n,mode,','.join(bonuses),field.value))
       except AttributeError:
         results.append('unknown %s "%s"' % (typ,n))
     return '\n'.join(results)
 
+  # evaluate stats as if some bonuses were toggled without changing anything
+  # @param on (str,list) [None] bonus(es) or effect(s) to turn on
+  # @param off (str,list) [None] bonus(es) or effect(s) to turn off
+  # @return (Overlay) use its value() to look at stats
+  # @raise KeyError if a name is neither a bonus nor an effect
+  def what_if(self,on=None,off=None):
+
+    overlay = Overlay(self)
+    for (names,active) in ((on,True),(off,False)):
+      if names is None:
+        continue
+      for name in (names if isinstance(names,list) else [names]):
+        overlay.toggle(name,active)
+    return overlay
+
   # @raise KeyError if typ or name do not exist
   def all(self,typ,name):
     """
@@ -657,6 +1160,48 @@ class Character(object):
     except AttributeError:
       raise KeyError('unknown %s "%s"' % (typ,name))
 
+  # @raise KeyError if name does not exist
+  # @raise ValueError if there are too many bonuses
+  def conditions(self,name,bonuses=None):
+    """
+    show a stat's value for every combination of its conditional bonuses
+      - name (string) the stat
+      - [bonuses = ALL] (string,list) only these bonus(es) or effect(s)
+    """
+
+    try:
+      stat = self.stats[name]
+    except KeyError:
+      raise KeyError('unknown stat "%s"' % name)
+
+    # conditional bonuses on anything we use, unless their effect is inactive
+    if bonuses is None:
+      bonuses = []
+      for (_,b) in stat.get_bonuses()[1]:
+        if b.name in bonuses:
+          continue
+        if not b.effects or any(self.effects[e].is_active() for e in b.effects):
+          bonuses.append(b.name)
+    elif not isinstance(bonuses,list):
+      bonuses = [bonuses]
+    if not bonuses:
+      return 'no conditional bonuses for stat "%s"' % name
+    if len(bonuses)>self.CONDITIONS:
+      raise ValueError('%s bonuses is too many (max %s)'
+          % (len(bonuses),self.CONDITIONS))
+
+    values = Overlay(self).combinations(stat,bonuses)
+    width = max(len('value'),*(len(str(v)) for v in values))
+    lines = [' | '.join(['%*s' % (width,'value')]+bonuses)]
+    for (mask,value) in enumerate(values):
+      row = ['%*s' % (width,value)]
+      for (i,b) in enumerate(bonuses):
+        row.append('%-*s' % (len(b),'-+'[mask>>i & 1]))
+      lines.append(' | '.join(row).rstrip())
+    return '\n'.join(lines)
+
+  @journaled
+  @batched
   def advance(self,duration=1,effects='*'):
     """
     advance Effects and check for their expiry
@@ -694,9 +1239,11 @@ class Character(object):
       raise DuplicateError('stat "%s" already exists' % stat.name)
     stat.plug(self)
     self.stats[stat.name] = stat
+    self._changed('stats',stat.name,None)
 
   # @raise DuplicateError if name already exists
   # @raise FormulaError if formula contains errors
+  @journaled
   def add_stat(self, name, formula='0', text='', updated=None):
     """
     add a new Stat
@@ -714,6 +1261,7 @@ class Character(object):
 
   # @raise KeyError if name does not exist
   # @raise DependencyError if delete would break hierarchy
+  @journaled
   def del_stat(self,name):
     """
     delete a Stat
@@ -726,9 +1274,11 @@ class Character(object):
       del self.stats[name]
     except KeyError:
       raise KeyError('unknown stat "%s"' % name)
+    self._changed('stats',name,stat)
 
   # @raise KeyError if name does not exist
   # @raise FormulaError if formula contains errors
+  @journaled
   @arbargs
   def set_stat(self, name, **kwargs):
     """
@@ -749,17 +1299,26 @@ class Character(object):
       if old.uses:
         raise ProtectedError('stat "%s" is not a root (use force)' % name)
 
+    # most changes (e.g. a new formula) are made in place
+    if kwargs.keys()<=old.UPDATE.keys():
+      old.update(**kwargs)
+      return
+
     # to preserve atomicity, copy the existing stat, modify it, then replug
     new = old.copy(**kwargs)
+    new.leaf = not new.usedby
     old.unplug(force=True)
 
     try:
       self.stats[name] = new
       new.plug(self)
     except FormulaError:
+      old.usedby = new.usedby
+      old.leaf = not new.usedby
       old.plug(self)
       self.stats[name] = old
       raise
+    self._changed('stats',name,old)
 
   # @param bonus (Bonus) the Bonus to add
   # @raise DuplicateError if the name already exists
@@ -773,9 +1332,11 @@ class Character(object):
     except:
       del self.bonuses[bonus.name]
       raise
+    self._changed('bonuses',bonus.name,None)
 
   # @raise DuplicateError if name already exists
   # @raise FormulaError if formula contains errors
+  @journaled
   def add_bonus(self, name, formula, stats,
       typ=None, cond=None, text=None, active=True, updated=None):
     """
@@ -796,6 +1357,7 @@ class Character(object):
 
   # @raise KeyError if name does not exist
   # @raise FormulaError if formula contains errors
+  @journaled
   @arbargs
   def set_bonus(self, name, **kwargs):
     """
@@ -808,6 +1370,11 @@ class Character(object):
     except KeyError:
       raise KeyError('unknown bonus "%s"' % name)
 
+    # most changes (e.g. a new formula) are made in place
+    if kwargs.keys()<=old.UPDATE.keys():
+      old.update(**kwargs)
+      return
+
     # to preserve atomicity, copy the existing Bonus, modify it, then replug
     new = old.copy(**kwargs)
     old.unplug(force=True)
@@ -818,8 +1385,10 @@ class Character(object):
       old.plug(self)
       raise
     self.bonuses[name] = new
+    self._changed('bonuses',name,old)
 
   # @raise KeyError if name does not exist
+  @journaled
   def del_bonus(self,name):
     """
     delete a Bonus
@@ -827,11 +1396,13 @@ class Character(object):
     """
 
     try:
-      self.bonuses[name].unplug()
+      bonus = self.bonuses[name]
     except KeyError:
       raise KeyError('unknown bonus "%s"' % name)
 
+    bonus.unplug()
     del self.bonuses[name]
+    self._changed('bonuses',name,bonus)
 
   # @param effect (Effect) the Effect to add
   # @raise DuplicateError if the name already exists
@@ -841,8 +1412,10 @@ class Character(object):
       raise DuplicateError('effect "%s" already exists' % effect.name)
     effect.plug(self)
     self.effects[effect.name] = effect
+    self._changed('effects',effect.name,None)
 
   # @raise DuplicateError if name already exists
+  @journaled
   def add_effect(self,name,bonuses,duration=None,text=None,active=True):
     """
     add a new Effect
@@ -857,6 +1430,7 @@ class Character(object):
     self._add_effect(effect)
 
   # @raise KeyError if name does not exist
+  @journaled
   def set_effect(self,name,bonuses=None,duration=None):
     """
     modify an existing Effect
@@ -871,6 +1445,7 @@ class Character(object):
     try:
       effect.unplug()
       del self.effects[name]
+      self._changed('effects',name,effect)
       self.add_effect(name,bonuses,duration,effect.text,effect.is_active())
     except Exception:
       effect.plug(self)
@@ -878,6 +1453,7 @@ class Character(object):
       raise
 
   # @raise KeyError if name does not exist
+  @journaled
   def del_effect(self, name, recursive=False):
     """
     delete an Effect
@@ -892,6 +1468,7 @@ class Character(object):
 
     e.unplug()
     del self.effects[name]
+    self._changed('effects',name,e)
 
     if recursive is not False:
       for bonus in e.bonuses:
@@ -904,8 +1481,10 @@ class Character(object):
     if text.name in self.texts:
       raise DuplicateError('text "%s" already exists' % text.name)
     self.texts[text.name] = text
+    self._changed('texts',text.name,None)
 
   # @raise DuplicateError if name already exists
+  @journaled
   def add_text(self,name,text):
     """
     add a new Text blurb
@@ -917,6 +1496,7 @@ class Character(object):
     self._add_text(text)
 
   # @raise KeyError if name does not exist
+  @journaled
   def set_text(self,name,text):
     """
     modify an existing Text
@@ -929,9 +1509,11 @@ class Character(object):
     except KeyError:
       raise KeyError('unknown text "%s"' % name)
 
+    self._remember(t,'text')
     t.set(text)
 
   # @raise KeyError if name does not exist
+  @journaled
   def del_text(self,name):
     """
     delete a Text blurb
@@ -939,11 +1521,13 @@ class Character(object):
     """
 
     try:
-      del self.texts[name]
+      text = self.texts.pop(name)
     except KeyError:
       raise KeyError('unknown text "%s"' % name)
+    self._changed('texts',name,text)
 
   # @raise KeyError if name does not exist
+  @journaled
   def on(self,name):
     """
     activate a Bonus
@@ -956,6 +1540,7 @@ class Character(object):
       raise KeyError('unknown bonus "%s"' % name)
 
   # @raise KeyError if name does not exist
+  @journaled
   def off(self, name, force=False):
     """
     deactivate a Bonus
@@ -969,6 +1554,7 @@ class Character(object):
       raise KeyError('unknown bonus "%s"' % name)
 
   # @raise KeyError if name does not exist
+  @journaled
   def revert(self,name):
     """
     revert a bonus or effect to its last state
@@ -983,6 +1569,8 @@ class Character(object):
       raise KeyError('unknown bonus/effect "%s"' % name)
 
   # @raise KeyError if name does not exist
+  @journaled
+  @batched
   def reset(self,names):
     """
     reset the duration of (and activate) effect(s)
@@ -999,6 +1587,8 @@ class Character(object):
       raise KeyError('unknown effect "%s"' % name)
 
   # @raise KeyError if name does not exist
+  @journaled
+  @batched
   def expire(self, names):
     """
     exhaust the duration of (and deactivate) effect(s)
@@ -1014,6 +1604,24 @@ class Character(object):
     except KeyError:
       raise KeyError('unknown effect "%s"' % name)
 
+  # @raise ValueError if there's nothing to undo
+  def undo(self,n=1):
+    """
+    undo the last command(s) that changed something
+      - [n = 1] (int) how many commands to undo
+    """
+
+    self._step(self._undo,self._redo,n,'undo')
+
+  # @raise ValueError if there's nothing to redo
+  def redo(self,n=1):
+    """
+    redo command(s) that were undone
+      - [n = 1] (int) how many commands to redo
+    """
+
+    self._step(self._redo,self._undo,n,'redo')
+
 ###############################################################################
 # Setup wizard-esque commands
 ###############################################################################
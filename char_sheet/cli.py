@@ -67,6 +67,7 @@
 # eval command
 # exec command
 # trace
+# calcs [num|on|off|clear]
 #
 # ===== NOT IMPLEMENTED =====
 # time num [rd|min|hr|day]
@@ -92,6 +93,8 @@ from argparse import ArgumentParser
 import environ
 import dnd.char_sheet.char as char
 from dnd.char_sheet.dec import arbargs
+from dnd.char_sheet.journal import Journal
+from dnd.char_sheet.trace import Tracer
 from dnd.dice import Dice
 
 ###############################################################################
@@ -132,7 +135,9 @@ def get_args(args):
   add('-l', '--log-file',
     help='File to use for logging')
   add('-d', '--debug', action='store_true',
-    help='Enable debug logging (requires -l)')
+    help='Enable stat tracing and debug logging (requires -l)')
+  add('-j', '--journal', action='store_true',
+    help='Autosave after every command to a journal next to the file')
 
   return vars(ap.parse_args(args))
 
@@ -179,7 +184,9 @@ class CLI(cmd.Cmd):
   # @param file_name (str) [None] file name to load
   # @param log_file (str) [None] file to use for logging
   # @param debug (bool) [False] enable debug logging
-  def __init__(self, file_name=None, log_file=None, debug=False):
+  # @param journal (bool) [False] autosave to a Journal after every command
+  def __init__(self, file_name=None, log_file=None, debug=False,
+      journal=False):
 
     cmd.Cmd.__init__(self)
     self.prompt = Prompt(self.get_prompt)
@@ -202,6 +209,16 @@ class CLI(cmd.Cmd):
       )
       self.logger = logging.getLogger()
 
+    # only debug mode pays for tracing, see do_calcs()
+    self.tracer = Tracer(logger=self.logger) if debug else None
+
+    # set by start_journal() once we have both a character and a file, along
+    # with the revision of the character the journal is up to
+    self.journaling = journal
+    self.journal = None
+    self.last_cmd = None
+    self.revision = 0
+
     if self.fname:
       self.do_load([self.fname])
 
@@ -282,7 +299,12 @@ class CLI(cmd.Cmd):
         self.info('    CHARCMD %s' % char_func.__name__)
         self.check_args(char_func,char_args,kwargs,
             getattr(char_func,'_arbargs',False))
-        result = char_func(*char_args,**kwargs)
+        if getattr(char_func,'_batched',False):
+          with self.char.batch():
+            result = char_func(*char_args,**kwargs)
+        else:
+          result = char_func(*char_args,**kwargs)
+        self.last_cmd = (char_func,char_args,kwargs)
         if result!=NotImplemented:
           if result:
             self.output(result)
@@ -367,6 +389,7 @@ class CLI(cmd.Cmd):
   # @param line (str)
   def postcmd(self,stop,line):
 
+    self.autosave()
     print('')
     return stop
 
@@ -489,6 +512,8 @@ class CLI(cmd.Cmd):
 
     self.unplug()
     self.char = char
+    char.tracer = self.tracer
+    char.track_changes()
 
     # basic commands
     self.exported = {name:getattr(char,name) for name in char.export}
@@ -517,6 +542,37 @@ class CLI(cmd.Cmd):
 
     self.char = None
     self.exported = {}
+    self.journal = None
+
+  # start journaling to our file if journaling is on and we have one
+  def start_journal(self):
+
+    self.journal = None
+    if self.journaling and self.char and self.fname:
+      self.journal = Journal(self.fname)
+      self.journal.start()
+      self.revision = self.char.revision
+
+  # make the last command one step for undo and if it changed anything,
+  # append it to our journal or write a new snapshot if it can't be replayed
+  # (e.g. it asked for input or was an undo)
+  def autosave(self):
+
+    (cmd,self.last_cmd) = (self.last_cmd,None)
+    if self.char is None:
+      return
+    self.char.checkpoint()
+    if self.journal is None or self.char.revision==self.revision:
+      return
+    steps = self.char.revision-self.revision
+    self.revision = self.char.revision
+
+    (func,args,kwargs) = cmd or (None,None,None)
+    if steps==1 and getattr(func,'_journaled',False):
+      self.journal.append(self.char,func.__name__,args,kwargs)
+    else:
+      self.journal.compact(self.char)
+    self.modified = False
 
   # @param fname (str) the destination file
   # @return (bool) if saving was successful
@@ -534,6 +590,7 @@ class CLI(cmd.Cmd):
     self.char.save(fname)
     self.fname = fname
     self.modified = False
+    self.start_journal()
 
     return True
 
@@ -668,9 +725,10 @@ class CLI(cmd.Cmd):
         self.plug(c)
         self.fname = args[0]
         self.modified = False
+        self.start_journal()
 
   def do_save(self,args):
-    """save a character to a file"""
+    """save a character to a file (binary if it ends in .chb)"""
 
     self.save(self.fname if not args else ' '.join(args))
 
@@ -734,6 +792,22 @@ class CLI(cmd.Cmd):
 
     self.output(self.last_trace)
 
+  def do_calcs(self,args):
+    """[DEV] show the last N (default 20) stat calcs or turn tracing on/off"""
+
+    arg = args[0] if args else '20'
+    if arg in ('on','off'):
+      self.tracer = Tracer(logger=self.logger) if arg=='on' else None
+      if self.char:
+        self.char.tracer = self.tracer
+      self.output('Tracing: %s' % arg)
+    elif self.tracer is None:
+      self.output('Tracing is off (use "calcs on" or the -d flag)')
+    elif arg=='clear':
+      self.tracer.clear()
+    else:
+      self.output('\n'.join(self.tracer.lines(int(arg))) or 'No events')
+
   def do_args(self,args):
     """[DEV] toggle printing args"""
 
@@ -2,4 +2,19 @@
 def arbargs(func):
   
   func._arbargs = True
-  return func
\ No newline at end of file
+  return func
+
+# decorator used for commands that change many fields, which the CLI runs
+# inside Character.batch()
+def batched(func):
+
+  func._batched = True
+  return func
+
+# decorator used for commands that can be replayed from a journal, meaning
+# they don't prompt for input and only depend on their arguments and the
+# state of the character
+def journaled(func):
+
+  func._journaled = True
+  return func
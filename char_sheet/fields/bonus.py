@@ -72,23 +72,27 @@ class Bonus(Stat):
       raise ValueError('%s.%s: invalid bonus type "%s"'
           % (self.__class__.__name__, self.name, self.typ))
 
-    super()._plug()
-
-    for name in self.stats:
-      stat = self.char.stats[name]
-      stat.add_bonus(self)
-      stat.calc(self)
-
     # some bonuses should never be turned off
     if not self.condition and self.typ in self.char.BONUS_PERM:
       self.active = True
 
+    # join our stats first so they're all recalculated in the same pass as us
+    stats = [self.char.stats[name] for name in self.stats]
+    for stat in stats:
+      stat.add_bonus(self)
+    try:
+      super()._plug()
+    except:
+      for stat in stats:
+        stat.del_bonus(self)
+      raise
+
   def _unplug(self, force=False):
 
-    for name in self.stats:
-      stat = self.char.stats[name]
+    stats = [self.char.stats[name] for name in self.stats]
+    for stat in stats:
       stat.del_bonus(self)
-      stat.calc(self)
+    self.char._recalc(stats)
 
     super()._unplug(force=force)
 
@@ -96,11 +100,40 @@ class Bonus(Stat):
   def get_value(self):
     return self.value
 
-  def calc(self, caller=None):
+  # keep the bonus totals of our stats up to date with our value
+  # @return (bool) if our value changed
+  def _eval(self):
+
+    changed = super()._eval()
+    if changed:
+      self._sync()
+    return changed
+
+  # tell our stats about a change in our value or active state
+  def _sync(self):
 
-    if not super().calc(caller):
-      for name in self.stats:
-        self.char.stats[name].calc(caller or self)
+    for name in self.stats:
+      self.char.stats[name]._update_bonus(self)
+
+  # our stats need their totals updated before anything is recalculated
+  # @param attrs (dict) attribute name to old value
+  def _restore(self, attrs):
+
+    self._restore_attrs(attrs)
+    self._sync()
+    self.calc()
+
+  # our stats are always recalculated since we might have been toggled
+  # @return (list of Stat)
+  def _calc_roots(self):
+    return [self] + [self.char.stats[name] for name in self.stats]
+
+  # @return (generator of Stat) the stats we modify and anything using us
+  def _dependants(self):
+
+    for name in self.stats:
+      yield self.char.stats[name]
+    yield from super()._dependants()
 
   def on(self):
     self.toggle(True)
@@ -123,17 +156,21 @@ class Bonus(Stat):
     # some bonuses should never be turned off
     if not self.condition and self.typ in self.char.BONUS_PERM:
       return
+    self.char._remember(self, 'active', 'last')
     self.last = self.active
     self.active = new
+    self._sync()
     self.calc()
 
-  # this is planned to be used for the "with" conditional which hasn't been
-  # implemented yet e.g. "get ac with mage_armor" / "get ac without mage_armor"
+  # go back to the state we were in before the last toggle; see Overlay for
+  # seeing what would happen without toggling e.g. "get ac with mage_armor"
   def revert(self):
 
     if self.active==self.last:
       return
+    self.char._remember(self, 'active', 'last')
     (self.active,self.last) = (self.last,self.active)
+    self._sync()
     self.calc()
 
   # looks like: [+] NAME VALUE STATS (type)
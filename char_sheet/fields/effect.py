@@ -69,6 +69,7 @@ class Effect(Field):
   # @return (bool) if we're expired after the advance
   def advance(self,dur=1):
 
+    self.char._remember(self,'duration','last')
     last = self.duration.copy()
     self.duration.advance(Duration(dur))
     self.last = last
@@ -86,6 +87,7 @@ class Effect(Field):
   # make our duration infinite (i.e. activate this effect)
   def make_permanent(self):
 
+    self.char._remember(self,'duration','last')
     self.last = self.duration.copy()
     self.duration = Duration()
     self.calc()
@@ -93,12 +95,14 @@ class Effect(Field):
   # expire our duration
   def expire(self):
 
+    self.char._remember(self,'duration','last')
     self.last = self.duration.copy()
     self.duration.expire()
     self.calc()
 
   # return to our original duration
   def reset(self):
+    self.char._remember(self,'duration','last')
     self.last = self.duration.copy()
     self.duration.reset()
     self.calc()
@@ -107,6 +111,7 @@ class Effect(Field):
 
     if self.duration==self.last:
       return
+    self.char._remember(self,'duration','last')
     (self.duration,self.last) = (self.last,self.duration)
     self.calc()
 
@@ -24,11 +24,19 @@
 import inspect
 import time
 from collections import OrderedDict
-from functools import reduce
+from functools import lru_cache, reduce
 
 from dnd.duration import Duration
 from dnd.char_sheet.errors import *
 
+# @param func (func) an __init__ method
+# @return (int) how many arguments it needs besides self
+@lru_cache(maxsize=None)
+def _required_args(func):
+
+  sig = inspect.getfullargspec(func)
+  return len(sig.args) - 1 - len(sig.defaults or [])
+
 ###############################################################################
 # Field class
 #   - parent class for objects used by Characters
@@ -51,8 +59,7 @@ class Field(object):
   @classmethod
   def load(cls, fields):
 
-    sig = inspect.getfullargspec(cls.__init__)
-    required = len(sig.args) - 1 - len(sig.defaults or [])
+    required = _required_args(cls.__init__)
     if len(fields) < required:
       raise ValueError('need %s args for %s but got %s' % (required, cls.__name__, len(fields)))
 
@@ -93,7 +100,8 @@ class Field(object):
   # @param (Character) the character to plug into
   def plug(self, char, *args, **kwargs):
 
-    char.debug('PLUG %s.%s' % (self.__class__.__name__, self.name))
+    if char.tracer is not None:
+      char.tracer.event('plug', self)
     self.char = char
     try:
       self._plug(*args, **kwargs)
@@ -109,11 +117,12 @@ class Field(object):
   # @raise DependencyError if other Fields depend on us
   def unplug(self, *args, **kwargs):
 
-    self.char.debug('UNPLUG %s.%s' % (self.__class__.__name__, self.name))
-
     if not self.char:
       raise RuntimeError('plug() must be called before unplug()')
 
+    if self.char.tracer is not None:
+      self.char.tracer.event('unplug', self)
+
     self._unplug(*args, **kwargs)
     self.char = None
 
@@ -125,6 +134,13 @@ class Field(object):
   def calc(self):
     pass
 
+  # put back attributes saved by Character._remember()
+  # @param attrs (dict) attribute name to old value
+  def _restore(self, attrs):
+
+    for (attr, val) in attrs.items():
+      setattr(self, attr, val)
+
   # what to print for the "search" command
   def str_search(self):
     return str(self)
@@ -1,11 +1,17 @@
+import builtins
+import heapq
+import itertools
+import re
 import time
 from collections import OrderedDict
 
+from dnd.char_sheet.errors import *
 from dnd.char_sheet.fields import Field
 
 ###############################################################################
 # Stat class
 #   - stat tracking and calculation via string formulas and eval()
+#   - formulas are compiled once in plug() and calc() just runs the code
 #   - stats are considered "root" nodes if their formula is static
 #   - or "leaf" nodes if no other stat depends on it
 #   - Example: dexterity > dex > _ac_dex > ac
@@ -40,10 +46,21 @@ class Stat(Field):
     'usedby'
   ]
 
-  VARS = {'$':'self.char.stats["%s"].value',
-    '#':'self.char.stats["%s"].normal',
+  # copy() kwargs that update() can change in place and the attributes
+  # they set
+  UPDATE = {
+    'formula': 'original',
+    'text': 'text',
+    'updated': 'updated',
   }
 
+  VARS = {'$':'stats["%s"].value',
+    '#':'stats["%s"].normal',
+  }
+
+  # matches $NAME, #NAME and @NAME with or without braces e.g. ${NAME}
+  ALIAS = re.compile(r'([$#@])(?:\{(\w+)\}|(\w+))')
+
   # @param name (str)
   # @param formula (str) ['0'] will get passed to eval()
   #   using $NAME refers to the value of the Stat by that name
@@ -79,45 +96,125 @@ class Stat(Field):
     self.root = True
     self.leaf = True
 
+    # set in plug(): compiled formula with and without bonuses and the
+    # namespace they run in
+    self._code_value = None
+    self._code_normal = None
+    self._env = None
+
+    # cached result of get_bonuses() or None if it needs rebuilding
+    self._bonus_index = None
+
+    # set by a binary load to skip alias expansion (and maybe compiling) in
+    # plug(): (expanded formula, names of stats used, value code, normal code)
+    self._resolved = None
+
+    # running totals of our active bonuses kept up to date by _update_bonus()
+    #   _contrib maps each active Bonus to the value it's counted with
+    #   _heaps has a max-heap of (-value, n, Bonus) per non-stacking type,
+    #     possibly with stale entries that are dropped once they reach the top
+    #   _best has the current top of each heap
+    #   _bonus_total is every stacking value plus every _best
+    self._contrib = {}
+    self._heaps = {}
+    self._best = {}
+    self._bonus_total = 0
+    self._seq = itertools.count()
+
     # overridden in sub-classes to specify additional fields to copy()
     self.COPY = []
 
   # @raise FormulaError
   def _plug(self):
 
-    # iterate over each stat in the character and replace matching #/$ aliases
-    s = self.formula
-    usedby = set()
-    for name in self.char.stats:
-      for (var,expand) in self.VARS.items():
-        orig = s
-        s = s.replace(var+name,expand % name)
-        s = s.replace('%s{%s}' % (var,name),expand % name)
-        if s!=orig:
-          self.uses.add(name)
-          self.root = False
-          usedby.add(self.char.stats[name])
-
-    # iterate over our attributes and replace matching @ aliases
-    for name in dir(self):
-      s = s.replace('@'+name,'self.'+name)
-      s = s.replace('@{'+name+'}','self.'+name)
+    self._wire(*self._compile(self.formula))
+
+    # while our Character is loading the stats we use may not have values yet,
+    # so it evaluates everything in one go at the end instead
+    if self.char._loading:
+      return
+    self._reindex_bonuses()
+    self._total_bonuses()
+    self.calc()
+
+  # expand the aliases in a formula and compile it without changing anything
+  # @param formula (str)
+  # @return (4-tuple)
+  #   #0 (str) the formula with aliases expanded
+  #   #1 (set of str) names of the stats it uses
+  #   #2 (2-tuple) compiled code for our value and our normal value
+  #   #3 (dict) the namespace the code runs in
+  # @raise FormulaError
+  def _compile(self,formula):
+
+    # expand every alias in one pass, looking up #/$ names in the character's
+    # stats and @ names in our attributes; whole names are matched so $con
+    # never expands inside $constitution
+    names = set()
+    def expand(match):
+      (var,name) = (match.group(1),match.group(2) or match.group(3))
+      if var=='@':
+        return 'self.'+name if hasattr(self,name) else match.group(0)
+      if name not in self.char.stats:
+        return match.group(0)
+      names.add(name)
+      return self.VARS[var] % name
+
+    code = (None,None)
+    if self._resolved is None:
+      s = self.ALIAS.sub(expand,formula)
+    else:
+      (s,used,code_value,code_normal) = self._resolved
+      self._resolved = None
+      names.update(used)
+      code = (code_value,code_normal)
 
     # if any aliases were invalid or misspelled, we'll have "#NAME" left which
     # will throw an exception in the eval()
     # of course can also throw syntax errors if something else is wrong
     try:
-      eval(s)
+      if code[0] is None:
+        code = (compile(s,'<%s>' % self.name,'eval'),
+            compile(s.replace('.value','.normal'),'<%s>' % self.name,'eval'))
+      env = {'__builtins__':builtins,'self':self,'stats':self.char.stats}
+      if not self.char._loading:
+        eval(code[0],env)
     except Exception as e:
       raise FormulaError('%s in "%s"' % (e.__class__.__name__,s))
 
-    # add ourselves as a dependant to stats that are in our formula
-    for stat in usedby:
+    return (s,names,code,env)
+
+  # switch to a compiled formula, only touching the stats we start or stop
+  # using; see _compile() for the params
+  def _wire(self,s,names,code,env):
+
+    stats = self.char.stats
+    for name in self.uses-names:
+      stat = stats[name]
+      stat.usedby.discard(self.name)
+      if not stat.usedby:
+        stat.leaf = True
+    for name in names-self.uses:
+      stat = stats[name]
       stat.usedby.add(self.name)
       stat.leaf = False
 
+    self.uses = names
+    self.root = not names
     self.formula = s
-    self.calc()
+    ((self._code_value,self._code_normal),self._env) = (code,env)
+
+  # change our formula while plugged in, leaving our value to the caller
+  # @param formula (str) with aliases, replacing original
+  # @param compiled (tuple) [None] what _compile() returned for it
+  # @raise FormulaError leaving us unchanged
+  def _rewire(self,formula,compiled=None):
+
+    uses = self.uses
+    self._wire(*(compiled or self._compile(formula)))
+    self.original = formula
+    if self.uses!=uses:
+      self._reindex_bonuses()
 
   # remove this stat from its character if possible
   # @param force (bool) [False] ignore dependency issues for this stat
@@ -138,6 +235,7 @@ class Stat(Field):
     self.usedby = set()
 
     self.formula = self.original
+    (self._code_value,self._code_normal,self._env) = (None,None,None)
 
     for name in self.uses:
       stat = self.char.stats[name]
@@ -148,6 +246,41 @@ class Stat(Field):
 
     self.root = True
     self.leaf = True
+    self._reindex_bonuses()
+
+  # change us without unplugging: a new formula only rewires the stats it
+  # starts or stops using and anything else is simply set
+  # @param kwargs (dict) keys from UPDATE, same as copy() takes
+  # @raise FormulaError leaving us unchanged
+  def update(self, **kwargs):
+
+    attrs = {}
+    for (kwarg,val) in kwargs.items():
+      attr = self.UPDATE[kwarg]
+      if attr=='original':
+        val = self._formula(val)
+      if getattr(self,attr)!=val:
+        attrs[attr] = val
+    if not attrs:
+      return
+
+    # compile before changing anything so a bad formula leaves us alone
+    formula = attrs.pop('original',None)
+    compiled = None if formula is None else self._compile(formula)
+    self.char._remember(self,*attrs,*(['original'] if compiled else []))
+    for (attr,val) in attrs.items():
+      setattr(self,attr,val)
+    if compiled:
+      self._rewire(formula,compiled)
+
+    # our text and timestamp don't change our value
+    if compiled or not attrs.keys()<={'text','updated'}:
+      self.calc()
+
+  # @param s (str) a formula as given by the user
+  # @return (str) the formula we should actually use
+  def _formula(self,s):
+    return str(s)
 
   # convenience method that sets self.formula and self.original
   # @param s (str) formula
@@ -161,53 +294,110 @@ class Stat(Field):
     self.formula = s
     self.original = s
 
+  # recalculate us and everything that depends on us
+  # @param caller (Stat) [None] the field asking, which we ignore if it's us
+  # @return (bool) True if we're the caller
   # @raise RuntimeError if we don't have a character
   def calc(self, caller=None):
 
     if caller and (type(self), self.name) == (type(caller), caller.name):
       return True
 
-    self.char.debug('CALC %s.%s (caller: %s)' % (
-        self.__class__.__name__, self.name,
-        'None' if not caller else '%s.%s' % (
-            caller.__class__.__name__, caller.name)))
-
     if not self.char:
       raise RuntimeError('%s.%s: plug() must be called before calc()'
           % (self.__class__.__name__, self.name))
 
-    (b, c) = self.get_bonuses()
-    b = ','.join(sorted([x[1].name for x in b])) or 'none'
-    c = ','.join(sorted([x[1].name for x in c])) or 'none'
-    self.char.debug('    FORMULA [%s] + (%s) ? (%s)' % (self.original, b, c))
+    self.char._recalc(self._calc_roots())
+
+  # put back attributes saved by Character._remember() and recalculate
+  # @param attrs (dict) attribute name to old value
+  def _restore(self, attrs):
+
+    self._restore_attrs(attrs)
+    self.calc()
+
+  # like Field._restore() but a formula is rewired rather than just set
+  # @param attrs (dict) attribute name to old value
+  def _restore_attrs(self, attrs):
+
+    for (attr, val) in attrs.items():
+      if attr=='original':
+        self._rewire(val)
+      else:
+        setattr(self, attr, val)
+
+  # @return (list of Stat) the fields calc() always re-evaluates
+  def _calc_roots(self):
+    return [self]
+
+  # @return (generator of Stat) fields that use our value in their formula
+  def _dependants(self):
+
+    for name in self.usedby:
+      try:
+        yield self.char.stats[name]
+      except KeyError:
+        yield self.char.bonuses[name]
+
+  # evaluate our formula and bonuses, leaving our dependants to the caller
+  # this is the hot path so any tracing happens in Character._recalc()
+  # @return (bool) if our value or normal value changed
+  def _eval(self):
 
     # evaluate our formula without bonuses
     old_v = self.value
     old_n = self.normal
-    self.normal = eval(self.formula.replace('.value','.normal'))
+    self.normal = eval(self._code_normal,self._env)
 
     # evaluate our formula with bonuses
-    self.value = eval(self.formula)
-    for (typ,bonuses) in self.bonuses.items():
-      bonuses = [b.get_value() for b in bonuses if b.active]
-      if not bonuses:
-        continue
-      if self.char._stacks(typ):
-        self.value += sum(bonuses)
-      else:
-        self.value += max(bonuses)
-
-    self.char.debug('    RESULT %s = %s + bonuses = %s'
-        % (self.name, self.normal, self.value))
+    self.value = eval(self._code_value,self._env)
+    if self._contrib:
+      self.value += self._bonus_total
+
+    return old_v!=self.value or old_n!=self.normal
+
+  # start our bonus totals from scratch
+  def _total_bonuses(self):
+
+    self._contrib = {}
+    self._heaps = {}
+    self._best = {}
+    self._bonus_total = 0
+    for bonuses in self.bonuses.values():
+      for bonus in bonuses:
+        self._update_bonus(bonus)
+
+  # adjust our bonus totals after a bonus was added, removed, toggled or
+  # changed value; O(1) for stacking types and O(log n) for the rest
+  # @param bonus (Bonus)
+  # @param removed (bool) [False] if the bonus no longer applies to us
+  def _update_bonus(self, bonus, removed=False):
+
+    old = self._contrib.pop(bonus,None)
+    new = None if removed or not bonus.active else bonus.get_value()
+    if new is not None:
+      self._contrib[bonus] = new
+    if old==new:
+      return
 
-    # if we changed, bubble the calc() up through our dependants
-    if old_v!=self.value or old_n!=self.normal:
-      for stat in self.usedby:
-        try:
-          stat = self.char.stats[stat]
-        except KeyError:
-          stat = self.char.bonuses[stat]
-        stat.calc(caller or self)
+    typ = bonus.typ
+    if self.char._stacks(typ):
+      self._bonus_total += (new or 0) - (old or 0)
+      return
+
+    # stale entries are ones that no longer match their bonus's contribution
+    heap = self._heaps.setdefault(typ,[])
+    if new is not None:
+      heapq.heappush(heap,(-new,next(self._seq),bonus))
+    while heap and self._contrib.get(heap[0][2])!=-heap[0][0]:
+      heapq.heappop(heap)
+    if len(heap)>4*len(self._contrib)+8:
+      heap[:] = [x for x in heap if self._contrib.get(x[2])==-x[0]]
+      heapq.heapify(heap)
+
+    best = -heap[0][0] if heap else 0
+    self._bonus_total += best - self._best.get(typ,0)
+    self._best[typ] = best
 
   # add a bonus to this stat that will affect its value
   # @param bonus (Bonus) the Bonus to add
@@ -218,6 +408,9 @@ class Stat(Field):
       self.bonuses[typ].append(bonus)
     else:
       self.bonuses[typ] = [bonus]
+    self._reindex_bonuses()
+    if self.char:
+      self._update_bonus(bonus)
 
   # remove a bonus from this stat
   # @param bonus (Bonus) the Bonus to remove
@@ -228,29 +421,67 @@ class Stat(Field):
     self.bonuses[typ] = [b for b in self.bonuses[typ] if b is not bonus]
     if not self.bonuses[typ]:
       del self.bonuses[typ]
+    self._reindex_bonuses()
+    if self.char:
+      self._update_bonus(bonus,removed=True)
 
   # return all bonuses that can affect this stat, including from dependencies
-  # @return (2-tuple)
-  #   #0 (list of Bonus) permanent bonuses
-  #   #1 (list of Bonus) conditional bonuses
+  # @return (2-tuple) cached so don't modify it
+  #   #0 (list of 2-tuple) permanent (stat name, Bonus) pairs
+  #   #1 (list of 2-tuple) conditional (stat name, Bonus) pairs
   def get_bonuses(self):
 
-    bonuses = []
-    conds = []
-    for typ in self.bonuses.values():
-      for b in typ:
-        if b.condition:
-          conds.append((self.name,b))
-        else:
-          bonuses.append((self.name,b))
-
-    # recurse over dependencies
-    for stat in self.uses:
-      (b,c) = self.char.stats[stat].get_bonuses()
-      bonuses += b
-      conds += c
-
-    return (bonuses,conds)
+    if self._bonus_index is None:
+      self._index_bonuses()
+    return self._bonus_index
+
+  # rebuild our bonus index and any stale ones we inherit from, dependencies
+  # first, each from its own bonuses plus the indexes of the stats it uses
+  def _index_bonuses(self):
+
+    # post-order walk with a stack so long chains can't hit the recursion limit
+    order = []
+    seen = {self}
+    stack = [(self,iter(self.uses))]
+    while stack:
+      (stat,uses) = stack[-1]
+      for name in uses:
+        used = self.char.stats[name]
+        if used._bonus_index is None and used not in seen:
+          seen.add(used)
+          stack.append((used,iter(used.uses)))
+          break
+      else:
+        stack.pop()
+        order.append(stat)
+
+    for stat in order:
+      bonuses = []
+      conds = []
+      for typ in stat.bonuses.values():
+        for b in typ:
+          if b.condition:
+            conds.append((stat.name,b))
+          else:
+            bonuses.append((stat.name,b))
+      for name in stat.uses:
+        (b,c) = self.char.stats[name]._bonus_index
+        bonuses += b
+        conds += c
+      stat._bonus_index = (bonuses,conds)
+
+  # mark our bonus index and those of everything downstream as stale; called
+  # when our bonuses change or our formula is rewired
+  def _reindex_bonuses(self):
+
+    # anything downstream of a stale index is already stale
+    stack = [self]
+    while stack:
+      stat = stack.pop()
+      stat._bonus_index = None
+      if stat.char:
+        stack.extend(x for x in Stat._dependants(stat)
+            if x._bonus_index is not None)
 
   # copy this Stat into a new object with specified changes
   # @param kwargs (dict) fields to update
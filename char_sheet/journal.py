@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+
+from dnd.char_sheet import binary
+
+###############################################################################
+# Journal class
+#   - an append-only log of commands run on a saved character, kept next to
+#     the character file so saving after every command costs one short line
+#     instead of rewriting the whole file
+#   - each record is one JSON line: [command name, args, kwargs]
+#   - the first line holds a hash of the snapshot the records apply to, so a
+#     journal left over from an older snapshot is never replayed onto a newer
+#     one (e.g. if we crash between writing a snapshot and clearing the log)
+#   - compact() writes a fresh snapshot and starts an empty journal
+###############################################################################
+
+class Journal(object):
+
+  EXT = '.journal'
+
+  # how many records to allow before compacting
+  LIMIT = 200
+
+  # @param fname (str) the character file
+  # @param limit (int) [LIMIT] compact after this many records
+  def __init__(self, fname, limit=None):
+
+    self.fname = fname
+    self.path = fname + self.EXT
+    self.limit = self.LIMIT if limit is None else limit
+    self.records = 0
+
+  # @param data (bytes) contents of a character file
+  # @return (str) what a journal for it starts with
+  @staticmethod
+  def header(data):
+    return json.dumps({'snapshot': hashlib.sha1(data).hexdigest()})
+
+  # keep using an existing journal if it belongs to the file on disk,
+  # otherwise start a new one
+  def start(self):
+
+    with open(self.fname, 'rb') as f:
+      header = self.header(f.read())
+    try:
+      with open(self.path) as f:
+        lines = f.read().split('\n')
+      if lines[0]==header:
+        self.records = len([x for x in lines[1:] if x])
+        return
+    except IOError:
+      pass
+    self._reset(header)
+
+  # @param header (str)
+  def _reset(self, header):
+
+    with open(self.path, 'w') as f:
+      f.write(header + '\n')
+    self.records = 0
+
+  # @param char (Character) the character after running the command
+  # @param name (str) name of the Character method that was run
+  # @param args (list)
+  # @param kwargs (dict)
+  # @return (bool) if it was written; False if we compacted instead
+  def append(self, char, name, args, kwargs):
+
+    if self.records>=self.limit:
+      self.compact(char)
+      return False
+    try:
+      line = json.dumps([name, args, kwargs], separators=(',', ':'))
+    except TypeError:
+      self.compact(char)
+      return False
+
+    with open(self.path, 'a') as f:
+      f.write(line + '\n')
+    self.records += 1
+    return True
+
+  # write a fresh snapshot and start an empty journal for it
+  # @param char (Character)
+  def compact(self, char):
+
+    tmp = self.fname + '.tmp'
+    char.save(tmp, binary=self.fname.endswith(binary.EXT))
+    with open(tmp, 'rb') as f:
+      header = self.header(f.read())
+    os.replace(tmp, self.fname)
+    self._reset(header)
+
+  # run the commands in the journal for a character file, if there is one
+  # @param char (Character) freshly loaded from fname
+  # @param fname (str) the character file
+  # @param data (bytes) contents of the character file
+  # @return (list of str) errors
+  @staticmethod
+  def replay(char, fname, data):
+
+    try:
+      with open(fname + Journal.EXT) as f:
+        lines = f.read().split('\n')
+    except IOError:
+      return []
+    if lines[0]!=Journal.header(data):
+      char.info('IGNORED stale journal %s' % (fname + Journal.EXT))
+      return []
+
+    # don't repeat messages like "Effect expired" that were already shown
+    (output, char.output) = (char.output, lambda *args: None)
+    records = [(i, x) for (i, x) in enumerate(lines) if x][1:]
+    errors = []
+    try:
+      for (n, (i, line)) in enumerate(records):
+        try:
+          (name, args, kwargs) = json.loads(line)
+        except ValueError:
+          # the last line can be cut short by a crash, so just drop it
+          if n==len(records)-1:
+            break
+          raise
+        func = getattr(char, name)
+        if getattr(func, '_batched', False):
+          with char.batch():
+            func(*args, **kwargs)
+        else:
+          func(*args, **kwargs)
+    except Exception as e:
+      s = 'journal %.4d | %s' % (i+1, line)
+      errors += [s, '*** %s: %s' % (e.__class__.__name__, e)]
+      for s in errors:
+        char.error(s)
+    finally:
+      char.output = output
+
+    if not errors:
+      char.info('REPLAYED %s journal records' % len(records))
+    return errors
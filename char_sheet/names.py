@@ -0,0 +1,45 @@
+import bisect
+
+###############################################################################
+# NameIndex class
+#   - finds the names containing some text without looking at every name,
+#     for plain (non-regex) queries in Character.search()
+#   - keeps every suffix of every name in a sorted list; the names containing
+#     the text are the ones with a suffix starting with it, and those
+#     suffixes are all next to each other in the list
+#   - never updated; the Character throws it away when names are added or
+#     removed and builds a new one the next time it's needed
+###############################################################################
+
+class NameIndex(object):
+
+  # @param names (iterable of str) in the order results should come back in
+  # @param ignore_case (bool) [False]
+  def __init__(self, names, ignore_case=False):
+
+    self.ignore_case = ignore_case
+    self.order = {}
+    suffixes = []
+    for (i, name) in enumerate(names):
+      self.order[name] = i
+      key = name.lower() if ignore_case else name
+      suffixes.extend((key[j:], name) for j in range(len(key)))
+    suffixes.sort()
+    self.suffixes = [s for (s, _) in suffixes]
+    self.names = [n for (_, n) in suffixes]
+
+  # @param s (str) plain text, not a regex
+  # @return (list of str) every name containing s, in their original order
+  def find(self, s):
+
+    if not s:
+      return list(self.order)
+    if self.ignore_case:
+      s = s.lower()
+
+    found = set()
+    i = bisect.bisect_left(self.suffixes, s)
+    while i<len(self.suffixes) and self.suffixes[i].startswith(s):
+      found.add(self.names[i])
+      i += 1
+    return sorted(found, key=self.order.__getitem__)
@@ -0,0 +1,161 @@
+import builtins
+from collections import namedtuple
+
+###############################################################################
+# Overlay class
+#   - answers "what if" questions like "what would my AC be with mage_armor?"
+#     without changing anything on the character
+#   - only holds the bonuses it toggled and the values that changed because
+#     of them; everything else is read straight from the character
+#   - fields are evaluated with their own compiled formulas, but in a
+#     namespace where stats[NAME] finds our value before the character's
+#   - any number of overlays can exist at once since they only ever read from
+#     the character they were made for
+###############################################################################
+
+# what a formula sees in place of a stat we recalculated
+Value = namedtuple('Value', 'value normal')
+
+class Overlay(object):
+
+  # @param char (Character)
+  def __init__(self, char):
+
+    self.char = char
+    self.evals = 0
+
+    # Bonus:bool pairs for the bonuses we toggled
+    self.active = {}
+
+    # Stat:Value pairs for every field we recalculated
+    self.values = {}
+
+    self._stats = _Stats(self)
+
+  # @param name (str) a bonus, or an effect to toggle all its bonuses
+  # @param active (bool) [True]
+  # @raise KeyError if name is neither a bonus nor an effect
+  def toggle(self, name, active=True):
+
+    char = self.char
+    if name in char.bonuses:
+      bonuses = [char.bonuses[name]]
+    elif name in char.effects:
+      bonuses = [char.bonuses[b] for b in char.effects[name].bonuses]
+    else:
+      raise KeyError('unknown bonus/effect "%s"' % name)
+
+    changed = []
+    for bonus in bonuses:
+      # some bonuses should never be turned off
+      if not bonus.condition and bonus.typ in char.BONUS_PERM:
+        continue
+      if self.is_active(bonus)!=active:
+        self.active[bonus] = active
+        changed.extend(char.stats[s] for s in bonus.stats)
+    self._recalc(changed)
+
+  # @param name (str) see toggle()
+  def on(self, name):
+    self.toggle(name, True)
+
+  # @param name (str) see toggle()
+  def off(self, name):
+    self.toggle(name, False)
+
+  # @param bonus (Bonus)
+  # @return (bool) if the bonus is on in this overlay
+  def is_active(self, bonus):
+    return self.active.get(bonus, bonus.active)
+
+  # @param field (Stat)
+  # @return (int) its value in this overlay
+  def value(self, field):
+
+    val = self.values.get(field)
+    return field.value if val is None else val.value
+
+  # @param field (Stat)
+  # @return (int) its normal (no bonuses) value in this overlay
+  def normal(self, field):
+
+    val = self.values.get(field)
+    return field.normal if val is None else val.normal
+
+  # evaluate a stat under every combination of some bonuses being on or off
+  #   - the combinations are walked in Gray code order, so each one is a
+  #     single toggle away from the last and only that bonus's subgraph is
+  #     recalculated
+  # @param stat (Stat)
+  # @param bonuses (list of str) see toggle()
+  # @return (list) the stat's value for each combination, indexed by a
+  #   bitmask where bit i is set if bonuses[i] is on
+  def combinations(self, stat, bonuses):
+
+    for name in bonuses:
+      self.off(name)
+    values = [self.value(stat)] * 2**len(bonuses)
+
+    gray = 0
+    for i in range(1, len(values)):
+      bit = (i & -i).bit_length() - 1
+      gray ^= 1 << bit
+      self.toggle(bonuses[bit], bool(gray & 1 << bit))
+      values[gray] = self.value(stat)
+    return values
+
+  # same as Character._recalc() but only ever writing to self.values
+  # @param fields (list of Stat) fields that need recalculating
+  def _recalc(self, fields):
+
+    dirty = set(fields)
+    for field in self.char._topo(fields):
+      if field in dirty and self._eval(field):
+        dirty.update(field._dependants())
+
+  # @param field (Stat)
+  # @return (bool) if its value or normal value changed
+  def _eval(self, field):
+
+    self.evals += 1
+    env = {'__builtins__':builtins, 'self':field, 'stats':self._stats}
+    normal = eval(field._code_normal, env)
+    value = eval(field._code_value, env) + self._bonus_total(field)
+
+    old = self.values.get(field, (field.value, field.normal))
+    self.values[field] = Value(value, normal)
+    return old!=(value, normal)
+
+  # @param stat (Stat)
+  # @return (int) what its active bonuses add up to in this overlay
+  def _bonus_total(self, stat):
+
+    # most stats have no bonuses we've changed so their total is still good
+    if not any(b in self.active or b in self.values
+        for bonuses in stat.bonuses.values() for b in bonuses):
+      return stat._bonus_total if stat._contrib else 0
+
+    total = 0
+    for (typ, bonuses) in stat.bonuses.items():
+      values = [self.value(b) for b in bonuses if self.is_active(b)]
+      if not values:
+        continue
+      if self.char._stacks(typ):
+        total += sum(values)
+      else:
+        total += max(values)
+    return total
+
+# the "stats" a formula sees when evaluated by an Overlay
+class _Stats(object):
+
+  # @param overlay (Overlay)
+  def __init__(self, overlay):
+    self.overlay = overlay
+
+  # @param name (str)
+  # @return (Stat,Value)
+  def __getitem__(self, name):
+
+    stat = self.overlay.char.stats[name]
+    return self.overlay.values.get(stat, stat)
@@ -5,6 +5,7 @@ from dnd import util
 from dnd.char_sheet.char import Character
 from dnd.char_sheet.fields import *
 from dnd.char_sheet.errors import *
+from dnd.char_sheet.dec import batched,journaled
 
 # [TODO] level up wiz
 # [TODO] multiclassing?
@@ -257,28 +258,22 @@ class Pathfinder(Character):
   def _setup(self, ignore_dupes=False):
 
     super()._setup(ignore_dupes)
+    skip = self.SKILLS.keys() & self.stats.keys() if ignore_dupes else ()
     for (name, formula) in self.SKILLS.items():
+      if name in skip:
+        continue
       if name in self.SKILLS_TINY_DEX:
         formula = '($str if $size>-2 else $dex)'
       elif name in self.SKILLS_SIZE:
         formula = '4*(4-$_size_index)'
       skill = PathfinderSkill(name, formula)
-      try:
-        self._add_stat(skill)
-      except DuplicateError:
-        if ignore_dupes:
-          pass
-        else:
-          raise
+      self._add_stat(skill)
 
+    skip = self.PF_BONUSES.keys() & self.bonuses.keys() if ignore_dupes else ()
     for (name, args) in self.PF_BONUSES.items():
-      try:
-        self.add_bonus(name, *args)
-      except DuplicateError:
-        if ignore_dupes:
-          pass
-        else:
-          raise
+      if name in skip:
+        continue
+      self.add_bonus(name, *args)
 
   # include hp, status, ac
   # @return (str)
@@ -365,6 +360,7 @@ class Pathfinder(Character):
 ###############################################################################
 
   # [TODO] consider making massive damage an Event for consistency
+  @journaled
   def dmg(self,damage,nonlethal=False):
     """
     take damage and update HP
@@ -386,6 +382,7 @@ class Pathfinder(Character):
       if damage>=50 and damage>=int(self._max_hp()/2):
         self.output('!!! Massive damage')
 
+  @journaled
   def heal(self,damage):
     """
     heal damage and update HP
@@ -410,6 +407,8 @@ class Pathfinder(Character):
     if nonlethal:
       self.set_stat('nonlethal', formula=self.stats['nonlethal'].value-nonlethal)
 
+  @journaled
+  @batched
   def skill(self,action='info',name=None,value=0):
     """
     manage skills
@@ -464,6 +463,7 @@ class Pathfinder(Character):
       if result:
         self.output(result)
 
+  @journaled
   def xp(self,action='info',value=0):
     """
     manage XP
@@ -520,6 +520,7 @@ class Pathfinder(Character):
 # Setup wizard
 ###############################################################################
 
+  @batched
   def wiz(self,action='help'):
     """
     character setup wizard for some automation
@@ -761,15 +762,18 @@ class PathfinderSkill(Stat):
     ('class_skill', bool),
   ])
 
-  # needed for Stat.copy()
+  # needed for Stat.copy(), which leaves trained_only to plug()
   COPY_KWARGS = Stat.COPY_KWARGS.copy()
-  COPY_KWARGS.append([
+  COPY_KWARGS.extend([
     'ranks',
     ('clas', 'class_skill'),
   ])
-  COPY_VARS = Stat.COPY_VARS.copy()
-  COPY_VARS.append([
-    'trained_only'
+
+  # needed for Stat.update()
+  UPDATE = Stat.UPDATE.copy()
+  UPDATE.update([
+    ('ranks', 'ranks'),
+    ('clas', 'class_skill'),
   ])
 
   # the first 6 args get passed to Stat
@@ -789,22 +793,29 @@ class PathfinderSkill(Stat):
 
     # Stat.__init__() with correct args
     super(PathfinderSkill,self).__init__(*args[:6],**kwargs)
+    self.set_formula(self._formula(self.formula))
 
+    self.trained_only = False
+
+  # our ranks and class skill bonus are always part of our formula
+  # @param s (str)
+  # @return (str)
+  def _formula(self,s):
+
+    s = str(s)
     f = '+@ranks+(3 if @class_skill and @ranks else 0)'
-    if '$dex' in self.original or '$str' in self.original:
+    if '$dex' in s or '$str' in s:
       f += '+${acp}'
 
     # we need a check here so we don't double up on the +3 class skills when
     # loading from a file
     # [TODO] consider a cleaner way of controlling this
-    if f not in self.formula:
-      self.set_formula(self.formula+f)
-
-    self.trained_only = False
+    return s if f in s else s+f
 
   # @param new (bool) [True]
   def set_cskill(self,new=True):
 
+    self.char._remember(self,'class_skill')
     self.class_skill = new
     self.calc()
 
@@ -823,6 +834,7 @@ class PathfinderSkill(Stat):
     if value>level:
       raise ValueError('ranks must be <= level=%s' % level)
 
+    self.char._remember(self,'ranks')
     self.ranks = value
     self.calc()
 
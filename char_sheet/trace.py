@@ -0,0 +1,80 @@
+import time
+from collections import deque, namedtuple
+
+###############################################################################
+# Tracer class
+#   - records what the stat engine does into a fixed size ring buffer
+#   - a Character only calls into us if its tracer isn't None, so tracing
+#     costs nothing unless it's turned on
+#   - events can also be logged as they happen if given a logger
+###############################################################################
+
+# one calc() of one field
+#   - caller is the name of the field whose change made us recalculate, or
+#     None if we were recalculated directly
+#   - duration is in seconds
+CalcEvent = namedtuple('CalcEvent',
+    'time typ name caller old new duration')
+
+# anything else e.g. a field being plugged in
+Event = namedtuple('Event', 'time kind typ name')
+
+class Tracer(object):
+
+  # @param size (int) [1000] how many events to keep
+  # @param logger (logging.Logger) [None] also log events at debug level
+  def __init__(self, size=1000, logger=None):
+
+    self.events = deque(maxlen=size)
+    self.logger = logger
+
+  # evaluate a field and record it
+  # @param field (Stat)
+  # @param caller (Stat) [None] the field whose change made this necessary
+  # @return (bool) if the field's value changed
+  def calc(self, field, caller=None):
+
+    old = field.value
+    start = time.perf_counter()
+    changed = field._eval()
+    end = time.perf_counter()
+
+    event = CalcEvent(time.time(), field.__class__.__name__, field.name,
+        caller and caller.name, old, field.value, end - start)
+    self.events.append(event)
+    if self.logger:
+      self.logger.debug('CALC %s.%s (caller: %s) [%s] %s -> %s', event.typ,
+          event.name, event.caller, field.original, event.old, event.new)
+    return changed
+
+  # record something that isn't a calc
+  # @param kind (str) e.g. "plug"
+  # @param field (Field)
+  def event(self, kind, field):
+
+    event = Event(time.time(), kind, field.__class__.__name__, field.name)
+    self.events.append(event)
+    if self.logger:
+      self.logger.debug('%s %s.%s', kind.upper(), event.typ, event.name)
+
+  def clear(self):
+    self.events.clear()
+
+  def __len__(self):
+    return len(self.events)
+
+  # @param n (int) [None] only the last n events
+  # @return (list of str) one line per event, oldest first
+  def lines(self, n=None):
+
+    events = list(self.events)[-n:] if n else self.events
+    lines = []
+    for e in events:
+      stamp = time.strftime('%H:%M:%S', time.localtime(e.time))
+      if isinstance(e, CalcEvent):
+        lines.append('%s calc %s.%s %s -> %s (%.1f us)%s' % (stamp, e.typ,
+            e.name, e.old, e.new, 1e6 * e.duration,
+            '' if e.caller is None else ' <- %s' % e.caller))
+      else:
+        lines.append('%s %s %s.%s' % (stamp, e.kind, e.typ, e.name))
+    return lines
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+from dnd.char_sheet.systems.pathfinder import Pathfinder
+
+# @param c (Character)
+# @return (dict) everything undo should put back
+def state(c):
+  return {
+    'stats': {n: (s.value, s.normal) for (n, s) in c.stats.items()},
+    'bonuses': {n: (b.value, b.active, b.last, sorted(b.effects))
+        for (n, b) in c.bonuses.items()},
+    'effects': {n: str(e) for (n, e) in c.effects.items()},
+  }
+
+def new_char():
+  c = Pathfinder()
+  c.track_changes()
+  c.add_bonus('dodgy', '2', 'ac', 'dodge', cond='when dodging')
+  c.add_bonus('belt', '2', 'dexterity', 'enhancement')
+  c.checkpoint()
+  return c
+
+def test_undo_add_effect_with_conditional_bonus():
+  c = new_char()
+  c.on('dodgy')
+  c.checkpoint()
+  before = state(c)
+
+  c.add_effect('evade', ['dodgy', 'belt'], '3')
+  c.checkpoint()
+  after = state(c)
+
+  c.undo()
+  assert state(c) == before
+  c.redo()
+  assert state(c) == after
+  c.undo()
+  assert state(c) == before
+
+def test_undo_del_effect_with_conditional_bonus():
+  c = new_char()
+  c.add_effect('evade', ['dodgy', 'belt'], '3')
+  c.on('dodgy')
+  c.checkpoint()
+  before = state(c)
+
+  c.del_effect('evade')
+  c.checkpoint()
+  after = state(c)
+
+  c.undo()
+  assert state(c) == before
+  c.redo()
+  assert state(c) == after
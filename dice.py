@@ -1,35 +1,690 @@
-from functools import reduce, total_ordering
+from array import array
+import cmath
+from collections import OrderedDict, defaultdict
+from fractions import Fraction
+from functools import lru_cache
+import math
+import operator
 import random
+import re
 import sys
+from types import MappingProxyType
+import weakref
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+########## Sampling helpers ##########
+
+# memoryview formats for unpacking random bytes by width
+_WIDTHS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+# draw k uniform integers from 1..sides using as few getrandbits() calls as
+# possible; values are masked to the smallest covering bit width and rejected
+# if too large, so the result is exactly uniform
+# @param rng (random.Random)
+# @param sides (int)
+# @param k (int) how many values to draw
+# @return (list of int)
+def randints(rng, sides, k):
+
+  bits = (sides - 1).bit_length()
+  if bits == 0:
+    return [1] * k
+  width = min(w for w in _WIDTHS if w * 8 >= bits) if bits <= 64 else None
+  if width is None:
+    return [rng.randrange(sides) + 1 for i in range(k)]
+
+  mask = (1 << bits) - 1
+  out = []
+  while len(out) < k:
+    need = k - len(out)
+    m = int(need * (mask + 1) / sides * 1.1) + 8
+    raw = rng.getrandbits(8 * width * m).to_bytes(width * m, 'little')
+    vals = memoryview(raw).cast(_WIDTHS[width])
+    out += [v + 1 for v in map(mask.__and__, vals) if v < sides]
+  del out[k:]
+  return out
+
+# maps random bytes to a 0-based roll for a die, or 255 if rejected
+# @param sides (int) at most 255
+# @return (bytes) a table for bytes.translate()
+@lru_cache(maxsize=None)
+def byte_table(sides):
+
+  mask = (1 << (sides - 1).bit_length()) - 1
+  return bytes((b & mask) if (b & mask) < sides else 255 for b in range(256))
+
+# @param rng (None,int,random.Random,numpy.random.Generator)
+#   ints are used as seeds; None uses numpy if available
+# @return (random.Random,numpy.random.Generator)
+def get_rng(rng=None):
+
+  if isinstance(rng, random.Random):
+    return rng
+  if numpy is not None:
+    if isinstance(rng, numpy.random.Generator):
+      return rng
+    return numpy.random.default_rng(rng)
+  if rng is None:
+    return random.Random()
+  if isinstance(rng, int):
+    return random.Random(rng)
+  raise TypeError('invalid random generator "%s"' % rng.__class__.__name__)
+
+# how many alias tables to keep around, see alias_table()
+ALIAS_CACHE = 128
+
+# Walker/Vose alias table over every total of a distribution so sampling
+# costs one random draw no matter how many dice are involved; built with
+# integer weights so stdlib sampling is exact
+class AliasTable:
+
+  __slots__ = ('lo', 'total', 'prob', 'alias', '_floats')
+
+  # @param lo (int) the lowest total
+  # @param weights (list of int) the number of ways to roll each total
+  def __init__(self, lo, weights):
+
+    n = len(weights)
+    total = sum(weights)
+    scaled = [w * n for w in weights]
+    prob = [total] * n
+    alias = list(range(n))
+    small = [i for (i, w) in enumerate(scaled) if w < total]
+    large = [i for (i, w) in enumerate(scaled) if w >= total]
+    while small and large:
+      (s, l) = (small.pop(), large.pop())
+      prob[s] = scaled[s]
+      alias[s] = l
+      scaled[l] -= total - scaled[s]
+      (small if scaled[l] < total else large).append(l)
+
+    self.lo = lo
+    self.total = total
+    self.prob = prob
+    self.alias = [lo + a for a in alias]
+    self._floats = None
+
+  def __len__(self):
+    return len(self.prob)
+
+  # @param rng (random.Random) [random]
+  # @return (func) takes no arguments and draws one total
+  def compile(self, rng=None):
+
+    getrandbits = (rng or random).getrandbits
+    (lo, total, prob, alias) = (self.lo, self.total, self.prob, self.alias)
+    span = len(prob) * total
+    bits = (span - 1).bit_length()
+
+    # one draw picks both the column and the coin flip within it
+    def roll():
+      r = getrandbits(bits)
+      while r >= span:
+        r = getrandbits(bits)
+      (i, u) = divmod(r, total)
+      return lo + i if u < prob[i] else alias[i]
+    return roll
+
+  # @param n (int) number of draws
+  # @param rng (random.Random,numpy.random.Generator)
+  # @return (numpy.ndarray,array.array) n totals
+  def roll_many(self, n, rng):
+
+    if isinstance(rng, random.Random):
+      roll = self.compile(rng)
+      return array('q', [roll() for i in range(n)])
+
+    # numpy can't hold huge integer weights so use float thresholds
+    if self._floats is None:
+      self._floats = (
+        numpy.array([p / self.total for p in self.prob]),
+        numpy.array(self.alias, dtype=numpy.int64),
+      )
+    (prob, alias) = self._floats
+    u = rng.random(n) * len(prob)
+    i = u.astype(numpy.int64)
+    return numpy.where(u - i < prob[i], self.lo + i, alias[i])
+
+# cached on the Dice itself which hashes on its key, since strings can't
+# always tell two expressions apart
+# @param dice (Dice)
+# @return (AliasTable) cached with LRU eviction
+@lru_cache(maxsize=ALIAS_CACHE)
+def alias_table(dice):
+  return AliasTable(*dice.weights())
+
+########## Distribution helpers ##########
+
+# memoized weight lists for NdS keyed on (N, S), see dice_weights()
+_WEIGHTS = {}
+
+# @param a (list of int) weights starting at some offset
+# @param b (list of int) weights starting at some other offset
+# @return (list of int) weights of the sum, starting at the summed offsets
+def convolve(a, b):
+
+  if len(a) < len(b):
+    (a, b) = (b, a)
+  out = [0] * (len(a) + len(b) - 1)
+  for (j, y) in enumerate(b):
+    if y:
+      for (i, x) in enumerate(a, j):
+        out[i] += x * y
+  return out
+
+# the number of ways to roll each total on N dice with S sides
+# @param num (int) number of dice (positive)
+# @param sides (int)
+# @return (list of int) weights for the totals num..num*sides
+def dice_weights(num, sides):
+  return power_weights((1,) * sides, num)
+
+# the weights for the sum of N identical independent dice; larger pools are
+# built by squaring smaller ones e.g. 10d6 = 5d6 * 5d6
+# @param die (tuple of int) weights for one die
+# @param num (int) number of dice (positive)
+# @return (list of int) weights starting at num times the die's lowest value
+def power_weights(die, num):
+
+  key = (die, num)
+  if key not in _WEIGHTS:
+    if num == 1:
+      weights = list(die)
+    else:
+      half = power_weights(die, num // 2)
+      weights = convolve(half, half)
+      if num % 2:
+        weights = convolve(weights, die)
+    _WEIGHTS[key] = weights
+  return _WEIGHTS[key]
+
+# the weights for one die after rerolling and exploding
+# @param sides (int)
+# @param reroll (tuple of int) [()] faces that get rerolled once
+# @param explode (bool) [False] roll again and add on the max face
+# @return (tuple of int) weights for the values 1 and up
+@lru_cache(maxsize=None)
+def die_weights(sides, reroll=(), explode=False):
+
+  # a rerolled face is replaced by a second uniform roll
+  first = [sides * (v not in reroll) + len(reroll) for v in range(1, sides + 1)]
+  if not explode:
+    return tuple(first)
+
+  # chain is what gets added after a max roll, built from the deepest roll up
+  chain = [1] * sides
+  for i in range(EXPLODE_LIMIT - 1):
+    chain = [sum(chain)] * (sides - 1) + [0] + chain
+  total = sum(chain)
+  return tuple(
+    [w * total for w in first[:-1]] + [0] + [first[-1] * w for w in chain]
+  )
+
+# the weights for the sum of the highest (or lowest) dice in a pool; dice are
+# assigned one value at a time from the best value down and once enough are
+# kept the rest only have to roll worse, which has a closed form
+# @param die (tuple of int) weights for one die for the values 1 and up
+# @param num (int) number of dice rolled
+# @param keep (int) number of dice kept
+# @param high (bool) keep the highest dice instead of the lowest
+# @return (2-tuple)
+#   #0 (int) the lowest possible total
+#   #1 (list of int) weights for each total from there up
+def keep_weights(die, num, keep, high):
+
+  values = [(v, w) for (v, w) in enumerate(die, 1) if w]
+  if high:
+    values.reverse()
+
+  worse = sum(die)
+  totals = defaultdict(int)
+  states = {(0, 0): 1}
+  for (v, w) in values:
+    worse -= w
+    new = defaultdict(int)
+    for ((j, t), ways) in states.items():
+      left = num - j
+      for c in range(left + 1):
+        ways_c = ways * math.comb(left, c) * w ** c
+        total = t + min(c, keep - j) * v
+        if j + c >= keep:
+          totals[total] += ways_c * worse ** (left - c)
+        else:
+          new[(j + c, total)] += ways_c
+    states = new
+
+  lo = min(totals)
+  weights = [0] * (max(totals) - lo + 1)
+  for (t, w) in totals.items():
+    weights[t - lo] = w
+  return (lo, weights)
+
+# how two expressions compare, found in one sweep over the second one's totals
+# using running sums of the first's weights rather than every pair of totals
+# @param a (Dice)
+# @param b (Dice)
+# @param exact (bool) [False] use exact weights even for big expressions
+# @return (3-tuple of number) ways a beats b, ways they tie, and the total
+#   number of ways; ints when both use exact weights, see Dice._mass()
+@lru_cache(maxsize=1024)
+def compare_weights(a, b, exact=False):
+
+  (a_lo, a_w, a_total) = a._mass(exact)
+  (b_lo, b_w, b_total) = b._mass(exact)
+
+  # above[k] is the number of ways a rolls a_lo + k or more
+  above = [0] * (len(a_w) + 1)
+  for k in range(len(a_w) - 1, -1, -1):
+    above[k] = above[k + 1] + a_w[k]
+
+  greater = tie = 0
+  end = len(a_w)
+  for (j, w) in enumerate(b_w):
+    if w:
+      k = b_lo + j - a_lo
+      greater += w * above[min(max(k + 1, 0), end)]
+      if 0 <= k < end:
+        tie += w * a_w[k]
+  return (greater, tie, a_total * b_total)
+
+# above this many possible totals distribution() switches from exact integer
+# convolution to floating point FFTs, and above NORMAL_SPAN to a normal
+# approximation; see bench_crossover() in dice_bench.py
+FFT_SPAN = 150 if numpy is not None else 300
+NORMAL_SPAN = 100000
+
+# shorter inputs than this are convolved directly even in FFT mode
+FFT_MIN = 32
+
+# iterative radix-2 FFT for when numpy isn't available
+# @param vals (list of number) length must be a power of 2
+# @param invert (bool) [False] compute the unscaled inverse transform
+# @return (list of complex)
+def fft(vals, invert=False):
+
+  n = len(vals)
+  vals = [complex(v) for v in vals]
+  j = 0
+  for i in range(1, n):
+    bit = n >> 1
+    while j & bit:
+      j ^= bit
+      bit >>= 1
+    j |= bit
+    if i < j:
+      (vals[i], vals[j]) = (vals[j], vals[i])
+
+  sign = 1 if invert else -1
+  size = 2
+  while size <= n:
+    half = size // 2
+    twiddles = [cmath.exp(sign * 2j * math.pi * k / size) for k in range(half)]
+    for start in range(0, n, size):
+      for (k, w) in enumerate(twiddles, start):
+        (u, v) = (vals[k], vals[k + half] * w)
+        vals[k] = u + v
+        vals[k + half] = u - v
+    size *= 2
+  return vals
+
+# like convolve() but for float probabilities, in O(n log n)
+# @param a (list of float)
+# @param b (list of float)
+# @return (list of float) never negative
+def fft_convolve(a, b):
+
+  if min(len(a), len(b)) < FFT_MIN:
+    return convolve(a, b)
+
+  n = len(a) + len(b) - 1
+  size = 1 << (n - 1).bit_length()
+  if numpy is not None:
+    rfft = numpy.fft.rfft
+    out = numpy.fft.irfft(rfft(a, size) * rfft(b, size), size)[:n]
+    return numpy.maximum(out, 0.0).tolist()
+
+  fa = fft(list(a) + [0.0] * (size - len(a)))
+  fb = fft(list(b) + [0.0] * (size - len(b)))
+  out = fft([x * y for (x, y) in zip(fa, fb)], invert=True)
+  return [max(v.real / size, 0.0) for v in out[:n]]
+
+# like power_weights() but for float probabilities using fft_convolve()
+# @param die (list of float) probabilities for one die
+# @param num (int) number of dice (positive)
+# @return (list of float)
+def power_probs(die, num):
+
+  if num == 1:
+    return list(die)
+  half = power_probs(die, num // 2)
+  probs = fft_convolve(half, half)
+  if num % 2:
+    probs = fft_convolve(probs, die)
+  return probs
+
+# normal approximation with a continuity correction, evaluated at every
+# integer total; everything below lo and above hi is lumped into those two
+# so that the cumulative probability at every total is exactly the normal one
+# @param mean (float)
+# @param var (float) must be positive
+# @param lo (int) first total to evaluate
+# @param hi (int) last total to evaluate
+# @return (list of float) probabilities for lo..hi
+def normal(mean, var, lo, hi):
+
+  scale = 1 / math.sqrt(2 * var)
+  # probability of a total above x, from erfc so the upper tail stays accurate
+  above = lambda x: 0.5 * math.erfc((x - mean) * scale)
+  out = [above(x - 0.5) - above(x + 0.5) for x in range(lo, hi + 1)]
+  out[0] = 1 - above(lo + 0.5)
+  out[-1] = above(hi - 0.5) if lo < hi else 1.0
+  return out
+
+# normal approximation with the first Edgeworth correction terms for skew and
+# kurtosis, evaluated at every integer total
+# @param mean (float)
+# @param var (float) must be positive
+# @param k3 (float) third cumulant
+# @param k4 (float) fourth cumulant
+# @param lo (int) first total to evaluate
+# @param hi (int) last total to evaluate
+# @return (list of float) normalized probabilities for lo..hi
+def edgeworth(mean, var, k3, k4, lo, hi):
+
+  sd = math.sqrt(var)
+  (g1, g2) = (k3 / sd ** 3, k4 / var ** 2)
+  scale = 1 / (sd * math.sqrt(2 * math.pi))
+  out = []
+  for x in range(lo, hi + 1):
+    z = (x - mean) / sd
+    z2 = z * z
+    he3 = z * (z2 - 3)
+    he4 = z2 * z2 - 6 * z2 + 3
+    he6 = z2 * z2 * z2 - 15 * z2 * z2 + 45 * z2 - 15
+    p = scale * math.exp(-z2 / 2) * (
+      1 + g1 / 6 * he3 + g2 / 24 * he4 + g1 * g1 / 72 * he6
+    )
+    out.append(max(p, 0.0))
+  total = sum(out)
+  return [p / total for p in out]
+
+# the most times one exploding die can explode; the distribution and the
+# rollers both stop here so that they agree exactly
+EXPLODE_LIMIT = 10
+
+# one term of a Dice string e.g. 4d6, 4d6kh3, 1d20r1r2, d6!, 4d6!dl1
+TERM = re.compile(r'(-?\d*)d(\d+)((?:r\d+)*)(!?)(?:(kh|kl|k|dh|dl)(\d+))?')
+
+# a constant term of a Dice string
+CONST = re.compile(r'-?\d+')
+
+# this cache also keeps the most recently used expressions interned
+# @param s (str) normalized Dice string (lowercase without spaces)
+# @return (Dice)
+# @raise ValueError
+@lru_cache(maxsize=1024)
+def parse_normalized(s):
+
+  dice = {}
+  pools = {}
+  bonus = 0
+  for field in s.replace('-', '+-').split('+'):
+    if not field:
+      continue
+    if CONST.fullmatch(field):
+      bonus += int(field)
+      continue
+
+    match = TERM.fullmatch(field)
+    if not match:
+      raise ValueError('invalid Dice string "%s"' % s)
+    (num, sides, reroll, explode, mod, n) = match.groups()
+    num = -1 if num == '-' else int(num or 1)
+    sides = int(sides)
+    if sides < 1:
+      raise ValueError('invalid Dice string "%s"' % s)
+
+    if not (reroll or explode or mod):
+      Dice.dict_add(dice, sides, num)
+      continue
+
+    keep = None
+    if mod:
+      n = int(n)
+      keep = abs(num) - n if mod.startswith('d') else n
+    pool = Pool(
+      abs(num), sides,
+      reroll=[int(x) for x in reroll.split('r')[1:]],
+      explode=bool(explode),
+      keep=keep,
+      high=mod in ('k', 'kh', 'dl'),
+    )
+    Dice.dict_add(pools, pool, -1 if num < 0 else 1)
+
+  return Dice._make(dice, bonus, pools)
+
+# a group of identical dice with modifiers, which can't be merged with plain
+# dice e.g. 4d6kh3 (keep the highest 3), 1d20r1 (reroll 1s once) or 1d6!
+# (roll again and add on a 6); modifiers apply in that order: reroll the first
+# roll of each die, explode, and then keep some of the dice
+class Pool:
+
+  __slots__ = ('num', 'sides', 'reroll', 'explode', 'keep', 'high', 'key',
+      '_weights')
+
+  # @param num (int) number of dice
+  # @param sides (int)
+  # @param reroll (iterable of int) [()] faces that get rerolled once
+  # @param explode (bool) [False] roll again and add whenever we roll max
+  # @param keep (int) [None] how many dice to keep (None keeps them all)
+  # @param high (bool) [True] keep the highest dice instead of the lowest
+  # @raise ValueError
+  def __init__(self, num, sides, reroll=(), explode=False, keep=None,
+      high=True):
+
+    reroll = tuple(sorted(set(reroll)))
+    if num < 1 or sides < 1:
+      raise ValueError('invalid dice pool %sd%s' % (num, sides))
+    if any(r < 1 or r > sides for r in reroll):
+      raise ValueError('can only reroll faces 1-%s' % sides)
+    if explode and sides < 2:
+      raise ValueError('a d1 would explode forever')
+    if keep is not None and not 0 < keep <= num:
+      raise ValueError('can only keep 1-%s dice' % num)
+
+    self.num = num
+    self.sides = sides
+    self.reroll = reroll
+    self.explode = explode
+    self.keep = None if keep == num else keep
+    self.high = high if self.keep else True
+    # 0 stands in for keeping every die so that keys always sort
+    self.key = (sides, num, reroll, explode, self.keep or 0, self.high)
+    self._weights = None
+
+  def __eq__(self, other):
+    return isinstance(other, Pool) and self.key == other.key
+
+  def __hash__(self):
+    return hash(self.key)
+
+  def __lt__(self, other):
+    return self.key < other.key
+
+  # @return (2-tuple) cached so don't modify it, see Dice.weights()
+  def weights(self):
+
+    if self._weights is None:
+      die = die_weights(self.sides, self.reroll, self.explode)
+      if self.keep:
+        self._weights = keep_weights(die, self.num, self.keep, self.high)
+      else:
+        self._weights = (self.num, power_weights(die, self.num))
+    return self._weights
+
+  # @return (int) how many dice count towards the total
+  def kept(self):
+    return self.keep or self.num
+
+  def min(self):
+    return self.kept()
+
+  def max(self):
+    return self.kept() * self.sides * (EXPLODE_LIMIT + 1 if self.explode else 1)
+
+  # @return (float) the exact mean total
+  def avg(self):
+
+    if not self.keep:
+      die = die_weights(self.sides, self.reroll, self.explode)
+      mean = Fraction(sum(v * w for (v, w) in enumerate(die, 1)), sum(die))
+      return float(self.num * mean)
+
+    (lo, weights) = self.weights()
+    total = sum(i * w for (i, w) in enumerate(weights))
+    return float(lo + Fraction(total, sum(weights)))
+
+  # reroll and explode a flat list of rolls in place, drawing the extra dice
+  # for every die that needs them at once
+  # @param vals (list of int) first rolls
+  # @param draw (func) returns a list of k rolls when called with k
+  def _modify(self, vals, draw):
+
+    if self.reroll:
+      redo = [i for (i, v) in enumerate(vals) if v in self.reroll]
+      for (i, v) in zip(redo, draw(len(redo))):
+        vals[i] = v
+
+    if self.explode:
+      live = [i for (i, v) in enumerate(vals) if v == self.sides]
+      for depth in range(EXPLODE_LIMIT):
+        if not live:
+          break
+        extra = draw(len(live))
+        for (i, v) in zip(live, extra):
+          vals[i] += v
+        live = [i for (i, v) in zip(live, extra) if v == self.sides]
+
+  # @param rng (random.Random) [random]
+  # @return (func) takes no arguments and rolls this pool once
+  def compile(self, rng=None):
+
+    getrandbits = (rng or random).getrandbits
+    (num, sides, reroll, explode) = (self.num, self.sides, self.reroll,
+        self.explode)
+    (a, b) = (0, num)
+    if self.keep:
+      (a, b) = (num - self.keep, num) if self.high else (0, self.keep)
+    bits = (sides - 1).bit_length()
+    dice = range(num)
+
+    def die():
+      v = getrandbits(bits)
+      while v >= sides:
+        v = getrandbits(bits)
+      return v + 1
+
+    def roll():
+      vals = [die() for i in dice]
+      if reroll:
+        vals = [die() if v in reroll else v for v in vals]
+      if explode:
+        for (i, v) in enumerate(vals):
+          extra = v
+          for depth in range(EXPLODE_LIMIT):
+            if extra != sides:
+              break
+            extra = die()
+            vals[i] += extra
+      if self.keep:
+        vals.sort()
+      return sum(vals[a:b])
+    return roll
+
+  # @param n (int) number of rolls
+  # @param rng (random.Random,numpy.random.Generator)
+  # @return (list of int,numpy.ndarray) n totals
+  def roll_many(self, n, rng):
+
+    (num, sides, keep) = (self.num, self.sides, self.keep)
+
+    if isinstance(rng, random.Random):
+      draw = lambda k: randints(rng, sides, k)
+      vals = draw(n * num)
+      self._modify(vals, draw)
+      rows = zip(*[iter(vals)] * num)
+      if not keep:
+        return list(map(sum, rows))
+      (a, b) = (num - keep, num) if self.high else (0, keep)
+      return [sum(sorted(row)[a:b]) for row in rows]
+
+    vals = rng.integers(1, sides + 1, size=(n, num))
+    if self.reroll:
+      redo = numpy.isin(vals, self.reroll)
+      vals[redo] = rng.integers(1, sides + 1, size=redo.sum())
+    if self.explode:
+      live = vals == sides
+      for depth in range(EXPLODE_LIMIT):
+        k = live.sum()
+        if not k:
+          break
+        extra = rng.integers(1, sides + 1, size=k)
+        vals[live] += extra
+        live[live] = extra == sides
+    if keep:
+      vals.sort(axis=1)
+      vals = vals[:, num - keep:] if self.high else vals[:, :keep]
+    return vals.sum(axis=1)
+
+  def __str__(self):
+
+    s = '%sd%s' % (self.num, self.sides)
+    s += ''.join('r%s' % r for r in self.reroll)
+    s += '!' if self.explode else ''
+    if self.keep:
+      s += 'k%s%s' % ('h' if self.high else 'l', self.keep)
+    elif not (self.reroll or self.explode):
+      # e.g. 2d6kh2 still needs a modifier or it would parse as plain dice
+      s += 'kh%s' % self.num
+    return s
+
+  def __repr__(self):
+    return '<Pool %s>' % str(self)
 
-@total_ordering
+# Dice are immutable so equal expressions share one instance; min/avg/max and
+# the string are computed once when an expression is first built
 class Dice:
 
+  __slots__ = (
+    'dice', 'pools', 'bonus', 'key',
+    '_min', '_avg', '_max', '_str', '_weights', '_probs', '_roller',
+    '__weakref__',
+  )
+
+  # live instances keyed on (dice, bonus, pools), see _make()
+  _INTERNED = weakref.WeakValueDictionary()
+
+  # @param s (str) an expression of plain dice and constants
+  # @return (2-tuple) sides:num dict and the constant bonus
+  # @raise ValueError if s is invalid or has dice with modifiers, which don't
+  #   fit in the dict; use Dice(s).pools for those
   @staticmethod
   def parse(s):
 
-    s = str(s).replace(' ', '')
+    dice = parse_normalized(Dice.normalize(s))
+    if dice.pools:
+      raise ValueError('Dice.parse() only handles plain dice not "%s"' % s)
+    return (dict(dice.dice), dice.bonus)
 
-    if not reduce(lambda a, b: a and (b.isdigit() or b in 'd+-'), s, True):
-      raise ValueError('invalid Dice string "%s"' % s)
-
-    s = s.lower().replace('-', '+-')
-    fields = [x.strip() for x in s.split('+')]
-    dice = {}
-    bonus = 0
-    for field in fields:
-      if not field:
-        continue
-      if 'd' in field:
-        (num, sides) = field.split('d')
-        if num == '-':
-          num = -1
-        num = int(num or 1)
-        sides = int(sides)
-        Dice.dict_add(dice, sides, num)
-      else:
-        bonus += int(field)
-    return (dice, bonus)
+  # @param s (object)
+  # @return (str) the key for the parse cache
+  @staticmethod
+  def normalize(s):
+    return str(s).replace(' ', '').lower()
 
   @staticmethod
   def dict_add(d, k, v):
@@ -54,8 +709,104 @@ class Dice:
     else:
       return x
 
+  def __new__(cls, s=''):
+
+    if isinstance(s, Dice):
+      return s
+    return parse_normalized(Dice.normalize(s))
+
+  # get the shared instance for an expression, building it if needed
+  # @param dice (dict,iterable of 2-tuple) sides:num pairs
+  # @param bonus (int)
+  # @param pools (dict,iterable of 2-tuple) [None] Pool:num pairs
+  # @return (Dice)
+  @classmethod
+  def _make(cls, dice, bonus, pools=None):
+
+    dice = tuple(sorted((s, n) for (s, n) in dict(dice).items() if n))
+    pools = tuple(sorted((p, n) for (p, n) in dict(pools or {}).items() if n))
+    key = (dice, bonus, tuple((p.key, n) for (p, n) in pools))
+    try:
+      return cls._INTERNED[key]
+    except KeyError:
+      pass
+
+    new = object.__new__(cls)
+    init = lambda name, value: object.__setattr__(new, name, value)
+    init('dice', MappingProxyType(dict(dice)))
+    init('pools', MappingProxyType(dict(pools)))
+    init('bonus', bonus)
+    init('key', key)
+    init('_weights', None)
+    init('_probs', None)
+    init('_roller', None)
+    init('_min', new._calc_min())
+    init('_avg', new._calc_avg())
+    init('_max', new._calc_max())
+    init('_str', new._calc_str())
+
+    cls._INTERNED[key] = new
+    return new
+
+  # everything happens in __new__ so interned instances aren't re-initialized
   def __init__(self, s=''):
-    (self.dice, self.bonus) = Dice.parse(s)
+    pass
+
+  def __setattr__(self, name, value):
+    raise AttributeError('Dice objects are immutable')
+
+  def __delattr__(self, name):
+    raise AttributeError('Dice objects are immutable')
+
+  def __reduce__(self):
+    return (Dice, (str(self),))
+
+  # consistent with __eq__ so different expressions are different keys even
+  # when they have the same average e.g. 2d6 and 7
+  def __hash__(self):
+    return hash(self.key)
+
+########## Cached properties ##########
+
+  def _calc_min(self):
+
+    pos = [n for n in self.dice.values() if n > 0]
+    neg = [n * s for (s, n) in self.dice.items() if n < 0]
+    pools = [n * (p.min() if n > 0 else p.max()) for (p, n) in self.pools.items()]
+    return sum(pos) + sum(neg) + sum(pools) + self.bonus
+
+  def _calc_avg(self):
+
+    avg = 0
+    for (sides, num) in self.dice.items():
+      avg += num * (sides + 1) / 2.0
+    for (pool, num) in self.pools.items():
+      avg += num * pool.avg()
+    return Dice.intify(avg + self.bonus)
+
+  def _calc_max(self):
+
+    pos = [n * s for (s, n) in self.dice.items() if n > 0]
+    neg = [n for n in self.dice.values() if n < 0]
+    pools = [n * (p.max() if n > 0 else p.min()) for (p, n) in self.pools.items()]
+    return sum(pos) + sum(neg) + sum(pools) + self.bonus
+
+  def _calc_str(self):
+
+    sides = sorted(
+      self.dice.items(),
+      key=lambda x: x[1] * (x[0] + 1) / 2.0,
+      reverse=True,
+    )
+    s = '+'.join(['%sd%s' % (n, s) for (s, n) in sides])
+    for (pool, num) in self.pools.items():
+      s += ('-' if num < 0 else '+').join([''] + [str(pool)] * abs(num))
+    s = s.replace('+-', '-')
+    if self.bonus or not (self.dice or self.pools):
+      s += '%s%s' % ('+' if self.bonus > 0 else '', self.bonus)
+    if s.startswith('+'):
+      return s[1:]
+    return s
 
 ########## Numeric functions ##########
 
@@ -94,11 +845,11 @@ class Dice:
     if isinstance(obj, Dice):
       obj = obj.as_int(ignore=False)
     if isinstance(obj, int):
-      new = self.copy()
-      for d in new.dice:
-        new.dice[d] *= obj
-      new.bonus *= obj
-      return new
+      return Dice._make(
+        ((s, n * obj) for (s, n) in self.dice.items()),
+        self.bonus * obj,
+        ((p, n * obj) for (p, n) in self.pools.items()),
+      )
     else:
       return NotImplemented
 
@@ -107,7 +858,7 @@ class Dice:
 
   def __truediv__(self, obj):
 
-    if self.dice:
+    if self.dice or self.pools:
       raise ValueError("this Dice isn't just an integer bonus")
     if isinstance(obj, Dice):
       obj = obj.as_int(ignore=False)
@@ -118,7 +869,7 @@ class Dice:
 
   def __rtruediv__(self, obj):
 
-    if self.dice:
+    if self.dice or self.pools:
       raise ValueError("this Dice isn't just an integer bonus")
     if isinstance(obj, int):
       return obj / self.bonus
@@ -127,11 +878,7 @@ class Dice:
 
   def __neg__(self):
 
-    new = self.copy()
-    new.bonus *= -1
-    for sides in new.dice:
-      new.dice[sides] *= -1
-    return new
+    return self * -1
 
   def __int__(self):
     return self.as_int(ignore=False)
@@ -139,37 +886,52 @@ class Dice:
   def __float__(self):
     return float(int(self))
 
+  # equal means the same expression, so only a constant can equal an int
   def __eq__(self, other):
 
     if isinstance(other, Dice):
-      return self.avg() == other.avg()
+      return self.key == other.key
     elif isinstance(other, int):
-      return self.avg() == other
+      return not (self.dice or self.pools) and self.bonus == other
     return NotImplemented
 
+  # ordering compares averages, so neither a<b nor b<a doesn't mean a==b
   def __lt__(self, other):
+    return self.__cmp(other, operator.lt)
+
+  def __le__(self, other):
+    return self.__cmp(other, operator.le)
+
+  def __gt__(self, other):
+    return self.__cmp(other, operator.gt)
+
+  def __ge__(self, other):
+    return self.__cmp(other, operator.ge)
+
+########## Helper functions ##########
+
+  # @param other (Dice,int)
+  # @param op (function) from the operator module
+  def __cmp(self, other, op):
 
     if isinstance(other, Dice):
-      return self.avg() < other.avg()
+      return op(self._avg, other._avg)
     elif isinstance(other, int):
-      return self.avg() < other
+      return op(self._avg, other)
     return NotImplemented
 
-########## Helper functions ##########
-
   def __add_int(self, i):
-
-    dice = self.copy()
-    dice.bonus += i
-    return dice
+    return Dice._make(self.dice, self.bonus + i, self.pools)
 
   def __add_dice(self, d):
 
-    dice = self.copy()
+    dice = dict(self.dice)
     for (sides, num) in d.dice.items():
-      Dice.dict_add(dice.dice, sides, num)
-    dice.bonus += d.bonus
-    return dice
+      Dice.dict_add(dice, sides, num)
+    pools = dict(self.pools)
+    for (pool, num) in d.pools.items():
+      Dice.dict_add(pools, pool, num)
+    return Dice._make(dice, self.bonus + d.bonus, pools)
 
 ########## Methods ##########
 
@@ -180,18 +942,15 @@ class Dice:
         'invalid type %s for Dice.same()' % other.__class__.__name__
       )
 
-    return str(self) == str(other)
+    return self.key == other.key
 
+  # Dice are immutable so there's no need for a real copy
   def copy(self):
-
-    dice = Dice()
-    dice.dice = self.dice.copy()
-    dice.bonus = self.bonus
-    return dice
+    return self
 
   def as_int(self, ignore=True):
 
-    if not ignore and self.dice:
+    if not ignore and (self.dice or self.pools):
       raise ValueError("this Dice isn't just an integer bonus")
 
     return self.bonus
@@ -204,49 +963,383 @@ class Dice:
     return self.copy()
 
   def roll(self):
-
-    total = 0
+    return (self._roller or self._set_roller())()
+
+  def _set_roller(self):
+
+    object.__setattr__(self, '_roller', self.compile())
+    return self._roller
+
+  # specialize this expression into a function that rolls it; all the random
+  # bits for the plain dice come from a single getrandbits() call
+  # @param rng (random.Random) [random] source of random bits
+  # @param alias (bool) [False] sample from our cached alias table instead,
+  #   which costs one draw per roll however many dice there are
+  # @return (func) takes no arguments and returns a total like roll()
+  def compile(self, rng=None, alias=False):
+
+    if alias:
+      return self.alias().compile(rng)
+
+    rng = rng or random
+    plain = self._compile_dice(rng)
+    if not self.pools:
+      return plain
+
+    pools = [
+      (pool.compile(rng), -1 if num < 0 else 1)
+      for (pool, num) in self.pools.items() for i in range(abs(num))
+    ]
+    def roll():
+      total = plain()
+      for (pool, sign) in pools:
+        total += sign * pool()
+      return total
+    return roll
+
+  # @param rng (random.Random)
+  # @return (func) rolls our plain dice and adds the bonus
+  def _compile_dice(self, rng):
+
+    getrandbits = rng.getrandbits
+    base = self.bonus
+    terms = []
+    for (sides, num) in self.dice.items():
+      if sides == 1:
+        base += num
+      else:
+        terms.append((sides, abs(num), -1 if num < 0 else 1))
+
+    if not terms:
+      return lambda: base
+
+    # the most common case by far is a single d20
+    if len(terms) == 1 and terms[0][1] == 1:
+      (sides, num, sign) = terms[0]
+      bits = (sides - 1).bit_length()
+      def roll():
+        v = getrandbits(bits)
+        while v >= sides:
+          v = getrandbits(bits)
+        return base + sign * (v + 1)
+      return roll
+
+    # each term gets a slice of random bytes; rejected values are removed by
+    # the translate table and we top up from randints() if we run short
+    plan = []
+    big = []
+    nbytes = 0
+    for (sides, num, sign) in terms:
+      base += sign * num
+      if sides > 255:
+        big.append((sides, num, sign))
+        continue
+      mask = (1 << (sides - 1).bit_length()) - 1
+      size = int(num * (mask + 1) / sides * 1.25) + 4
+      plan.append((nbytes, nbytes + size, byte_table(sides), sides, num, sign))
+      nbytes += size
+
+    def roll():
+      raw = getrandbits(8 * nbytes).to_bytes(nbytes, 'little')
+      total = base
+      for (lo, hi, table, sides, num, sign) in plan:
+        vals = raw[lo:hi].translate(table).replace(b'\xff', b'')
+        if len(vals) < num:
+          vals += bytes(v - 1 for v in randints(rng, sides, num - len(vals)))
+        total += sign * sum(vals[:num])
+      for (sides, num, sign) in big:
+        total += sign * (sum(randints(rng, sides, num)) - num)
+      return total
+    return roll
+
+  # roll these dice many times at once
+  # @param n (int) number of rolls
+  # @param rng (None,int,random.Random,numpy.random.Generator) [None]
+  #   pass a seed or a seeded generator for reproducible results
+  # @param alias (bool) [False] sample from our cached alias table instead;
+  #   worth it for big expressions rolled many times
+  # @return (numpy.ndarray,array.array) n totals; numpy is used if available
+  #   unless rng is a random.Random, in which case we use getrandbits()
+  def roll_many(self, n, rng=None, alias=False):
+
+    rng = get_rng(rng)
+    if alias:
+      return self.alias().roll_many(n, rng)
+
+    if not isinstance(rng, random.Random):
+      totals = numpy.full(n, self.bonus, dtype=numpy.int64)
+      for (sides, num) in self.dice.items():
+        rolls = rng.integers(1, sides + 1, size=(n, abs(num)))
+        if num < 0:
+          totals -= rolls.sum(axis=1)
+        else:
+          totals += rolls.sum(axis=1)
+      for (pool, num) in self.pools.items():
+        for i in range(abs(num)):
+          if num < 0:
+            totals -= pool.roll_many(n, rng)
+          else:
+            totals += pool.roll_many(n, rng)
+      return totals
+
+    totals = array('q', [self.bonus]) * n
     for (sides, num) in self.dice.items():
-      neg = [1, -1][num < 0]
-      for i in range(0, num, neg):
-        total += random.randint(1, sides) * neg
-    return Dice.intify(total + self.bonus)
+      rolls = iter(randints(rng, sides, n * abs(num)))
+      sums = map(sum, zip(*[rolls] * abs(num)))
+      op = operator.sub if num < 0 else operator.add
+      totals = array('q', map(op, totals, sums))
+    for (pool, num) in self.pools.items():
+      op = operator.sub if num < 0 else operator.add
+      for i in range(abs(num)):
+        totals = array('q', map(op, totals, pool.roll_many(n, rng)))
+    return totals
 
   def min(self):
-
-    pos = [n for n in self.dice.values() if n > 0]
-    neg = [n * s for (s, n) in self.dice.items() if n < 0]
-    return sum(pos) + sum(neg) + self.bonus
+    return self._min
 
   def avg(self):
-
-    avg = 0
-    for (sides, num) in self.dice.items():
-      avg += num * (sides + 1) / 2.0
-    return Dice.intify(avg + self.bonus)
+    return self._avg
 
   def max(self):
-
-    pos = [n * s for (s, n) in self.dice.items() if n > 0]
-    neg = [n for n in self.dice.values() if n < 0]
-    return sum(pos) + sum(neg) + self.bonus
+    return self._max
 
   def stats(self):
     return self.__str__() + ' = %s/%s/%s' % (self.min(), self.avg(), self.max())
 
-  def __str__(self):
+########## Distribution functions ##########
 
-    sides = sorted(
-      self.dice.items(),
-      key=lambda x: x[1] * (x[0] + 1) / 2.0,
-      reverse=True,
-    )
-    s = '+'.join(['%sd%s' % (n, s) for (s, n) in sides]).replace('+-', '-')
-    if self.bonus or not self.dice:
-      s += '%s%s' % ('+' if self.bonus > 0 else '', self.bonus)
-    if s.startswith('+'):
-      return s[1:]
-    return s
+  # @return (2-tuple) cached so don't modify it
+  #   #0 (int) the lowest possible total
+  #   #1 (list of int) the number of ways to roll each total from there up
+  def weights(self):
+
+    if self._weights is not None:
+      return self._weights
+
+    lo = self.bonus
+    weights = [1]
+    for (sides, num) in sorted(self.dice.items()):
+      w = dice_weights(abs(num), sides)
+      if num < 0:
+        w = w[::-1]
+        lo -= sides * abs(num)
+      else:
+        lo += num
+      weights = convolve(weights, w)
+    for (pool, num) in self.pools.items():
+      (p_lo, w) = pool.weights()
+      if num < 0:
+        (p_lo, w) = (-(p_lo + len(w) - 1), w[::-1])
+      for i in range(abs(num)):
+        lo += p_lo
+        weights = convolve(weights, w)
+    object.__setattr__(self, '_weights', (lo, weights))
+    return self._weights
+
+  # @return (AliasTable) for sampling our distribution in one draw, shared
+  #   by every equal Dice and evicted least recently used
+  def alias(self):
+    return alias_table(self)
+
+  # @param exact (bool) [False] use Fractions instead of floats
+  # @param method (str) [None] how to build the distribution:
+  #   exact: integer convolution
+  #   fft: float FFT convolution, accurate to about 1e-15 per total
+  #   normal: normal approximation, see approx_error() for its error bound
+  #   edgeworth: normal approximation corrected for skew and kurtosis,
+  #     usually much closer than normal but with no error bound of its own
+  #   None: pick by the number of possible totals (FFT_SPAN, NORMAL_SPAN)
+  # @return (OrderedDict) total:probability for every possible total
+  # @raise ValueError if method is invalid or exact is used with a float method
+  def distribution(self, exact=False, method=None):
+
+    if method is None:
+      method = 'exact' if exact else self._method()
+    if method not in ('exact', 'fft', 'normal', 'edgeworth'):
+      raise ValueError('invalid distribution method "%s"' % method)
+    if exact and method != 'exact':
+      raise ValueError('method "%s" only gives floats' % method)
+
+    if method == 'exact' or not (self.dice or self.pools):
+      (lo, weights) = self.weights()
+      total = sum(weights)
+      div = Fraction if exact else lambda a, b: a / b
+      return OrderedDict([
+        (lo + i, div(w, total)) for (i, w) in enumerate(weights) if w
+      ])
+
+    (lo, probs) = self._fft_probs() if method == 'fft' else self._approx(method)
+    return OrderedDict([(lo + i, p) for (i, p) in enumerate(probs) if p])
+
+  # only the size matters so the same call always gives the same answer
+  # @return (str) the method distribution() uses when it isn't given one
+  def _method(self):
+
+    span = self._max - self._min + 1
+    if span <= FFT_SPAN:
+      return 'exact'
+    return 'fft' if span <= NORMAL_SPAN else 'normal'
+
+  # what the statistics below work from, so that like distribution() they
+  # don't build huge exact weights unless asked to
+  # @param exact (bool) [False] always use exact integer weights
+  # @return (3-tuple)
+  #   #0 (int) the lowest total
+  #   #1 (sequence of number) weight of each total from there
+  #   #2 (number) what the weights add up to
+  def _mass(self, exact=False):
+
+    method = 'exact' if exact else self._method()
+    if method == 'exact' or not (self.dice or self.pools):
+      (lo, weights) = self.weights()
+      return (lo, weights, sum(weights))
+
+    if self._probs is None:
+      probs = self._fft_probs() if method == 'fft' else self._approx(method)
+      object.__setattr__(self, '_probs', probs)
+    (lo, probs) = self._probs
+    return (lo, probs, sum(probs))
+
+  # @return (list of 3-tuple) the independent parts of this expression with
+  #   subtracted parts already flipped
+  #   #0 (int) lowest value of one part
+  #   #1 (sequence of int) weights of one part
+  #   #2 (int) how many times the part appears
+  def _parts(self):
+
+    parts = []
+    for (sides, num) in sorted(self.dice.items()):
+      parts.append((-sides if num < 0 else 1, (1,) * sides, abs(num)))
+    for (pool, num) in self.pools.items():
+      (p_lo, w) = pool.weights()
+      if num < 0:
+        (p_lo, w) = (-(p_lo + len(w) - 1), w[::-1])
+      parts.append((p_lo, w, abs(num)))
+    return parts
+
+  # @return (int, list of float) like weights() but probabilities from FFTs
+  def _fft_probs(self):
+
+    lo = self.bonus
+    probs = [1.0]
+    for (p_lo, w, num) in self._parts():
+      total = sum(w)
+      lo += p_lo * num
+      probs = fft_convolve(probs, power_probs([x / total for x in w], num))
+    return (lo, probs)
+
+  # @return (5-tuple of float) cumulants summed over our independent parts
+  #   #0 mean
+  #   #1 variance
+  #   #2 third cumulant
+  #   #3 fourth cumulant
+  #   #4 sum of third absolute central moments (for the Berry-Esseen bound)
+  def _cumulants(self):
+
+    out = [self.bonus, 0, 0, 0, 0]
+    for (p_lo, w, num) in self._parts():
+      total = sum(w)
+      probs = [(p_lo + i, x / total) for (i, x) in enumerate(w) if x]
+      mean = sum(v * p for (v, p) in probs)
+      m = [sum((v - mean) ** k * p for (v, p) in probs) for k in (2, 3, 4)]
+      rho = sum(abs(v - mean) ** 3 * p for (v, p) in probs)
+      for (i, x) in enumerate((mean, m[0], m[1], m[2] - 3 * m[0] ** 2, rho)):
+        out[i] += num * x
+    return tuple(out)
+
+  # @param method (str) normal or edgeworth, see distribution()
+  # @return (int, list of float) probabilities from the normal approximation,
+  #   trimmed to 12 standard deviations either side of the mean
+  def _approx(self, method):
+
+    (mean, var, k3, k4, rho) = self._cumulants()
+    sd = math.sqrt(var)
+    lo = max(self._min, math.floor(mean - 12 * sd))
+    hi = min(self._max, math.ceil(mean + 12 * sd))
+    if method == 'normal':
+      return (lo, normal(mean, var, lo, hi))
+    return (lo, edgeworth(mean, var, k3, k4, lo, hi))
+
+  # Berry-Esseen bound for distribution(method='normal'), which is also what
+  # big expressions get by default: no cumulative probability from it is off
+  # by more than this (Shevtsova's constant 0.56) apart from rounding
+  # @return (float)
+  def approx_error(self):
+
+    (mean, var, k3, k4, rho) = self._cumulants()
+    if not var:
+      return 0.0
+    return min(1.0, 0.56 * rho / var ** 1.5)
+
+  # @param x (int)
+  # @param exact (bool) [False] use exact weights even when there are more
+  #   than FFT_SPAN possible totals, which can take seconds
+  # @return (float) probability of rolling x or less
+  def cdf(self, x, exact=False):
+
+    (lo, weights, total) = self._mass(exact)
+    return sum(weights[:max(0, x - lo + 1)]) / total
+
+  # @param n (int)
+  # @param exact (bool) [False] see cdf()
+  # @return (float) probability of rolling n or more
+  def p_at_least(self, n, exact=False):
+
+    (greater, tie, total) = compare_weights(self, Dice(int(n)), exact)
+    return (greater + tie) / total
+
+  # @param other (Dice,str,int) e.g. the opposing roll
+  # @param exact (bool) [False] see cdf()
+  # @return (float) probability that we roll strictly higher
+  def p_greater(self, other, exact=False):
+
+    (greater, tie, total) = compare_weights(self, Dice(other), exact)
+    return greater / total
+
+  # @param other (Dice,str,int)
+  # @param exact (bool) [False] see cdf()
+  # @return (float) probability that we roll exactly the same
+  def p_tie(self, other, exact=False):
+
+    (greater, tie, total) = compare_weights(self, Dice(other), exact)
+    return tie / total
+
+  # @param q (float) probability between 0 and 1
+  # @param exact (bool) [False] see cdf()
+  # @return (int) the lowest total t such that cdf(t) >= q
+  def quantile(self, q, exact=False):
+
+    if not 0 <= q <= 1:
+      raise ValueError('quantile must be between 0 and 1 not "%s"' % q)
+
+    (lo, weights, total) = self._mass(exact)
+    target = q * total
+    cum = 0
+    for (i, w) in enumerate(weights):
+      cum += w
+      if w and cum >= target:
+        return lo + i
+    return lo + len(weights) - 1
+
+  # @param exact (bool) [False] use exact weights instead of the cumulants
+  #   for big expressions
+  # @return (float) the standard deviation of our totals
+  def stddev(self, exact=False):
+
+    if not exact and self._method() != 'exact':
+      return Dice.intify(math.sqrt(self._cumulants()[1]))
+
+    (lo, weights) = self.weights()
+    total = sum(weights)
+    mean = Fraction(sum(i * w for (i, w) in enumerate(weights)), total)
+    var = Fraction(sum(i * i * w for (i, w) in enumerate(weights)), total)
+    return Dice.intify(math.sqrt(var - mean * mean))
+
+  def __str__(self):
+    return self._str
 
   def __repr__(self):
     return '<Dice %s>' % str(self)
+
+# keep the standard dice interned even when nobody is holding one
+Dice._COMMON = tuple(Dice('1d%s' % s) for s in (2, 3, 4, 6, 8, 10, 12, 20, 100))
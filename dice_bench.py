@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+#
+# micro-benchmarks for dice.py
+#
+# usage: ./dice_bench.py [benchmark ...]
+#   runs every benchmark if none are named
+#
+# EXPRS = ['1d20', '4d6']
+# the dice expressions to time
+#
+# ROLLS = 100000
+# number of rolls per timing
+
+import random,sys,time
+
+import dice as dice_mod
+from dice import Dice
+
+EXPRS = ['1d20', '4d6', '20d6', '2d8+1d6+5']
+POOLS = ['2d20kh1', '4d6kh3', '1d20r1', '4d6r1dl1', '3d6!']
+ALIAS = ['4d6', '20d6+10d8', '4d6kh3', '10d6!']
+SPANS = [('d6', 5), ('d6', 10), ('d6', 20), ('d6', 40), ('d6', 80),
+  ('d6', 160), ('d12', 40), ('d12', 160)]
+ROLLS = 100000
+
+def main(args):
+
+  names = args or [x[6:] for x in sorted(globals()) if x.startswith('bench_')]
+  for name in names:
+    print('===== %s\n' % name)
+    globals()['bench_' + name]()
+    print('')
+
+# @param func (func) called with no arguments
+# @param n (int) [ROLLS] number of calls
+# @return (float) microseconds per call
+def timeit(func, n=ROLLS):
+
+  t = time.perf_counter()
+  for i in range(n):
+    func()
+  return 1e6 * (time.perf_counter() - t) / n
+
+# what Dice.roll() did before it was compiled
+def legacy_roll(dice):
+
+  total = 0
+  for (sides, num) in dice.dice.items():
+    neg = [1, -1][num < 0]
+    for i in range(0, num, neg):
+      total += random.randint(1, sides) * neg
+  return Dice.intify(total + dice.bonus)
+
+def bench_compile():
+
+  print('%-12s %10s %10s %6s' % ('dice', 'legacy us', 'roll us', 'gain'))
+  for expr in EXPRS:
+    dice = Dice(expr)
+    old = timeit(lambda: legacy_roll(dice))
+    new = timeit(dice.roll)
+    print('%-12s %10.3f %10.3f %5.1fx' % (expr, old, new, old / new))
+
+def bench_pools():
+
+  print('%-12s %10s %10s %12s' % ('dice', 'roll us', 'many us', 'plain us'))
+  rng = random.Random(0)
+  for expr in POOLS:
+    dice = Dice(expr)
+    pool = list(dice.pools)[0]
+    plain = Dice('%sd%s' % (pool.num, pool.sides))
+    one = timeit(dice.roll)
+    t = time.perf_counter()
+    dice.roll_many(ROLLS, rng)
+    many = 1e6 * (time.perf_counter() - t) / ROLLS
+    print('%-12s %10.3f %10.3f %12.3f' % (expr, one, many, timeit(plain.roll)))
+
+def bench_alias():
+
+  print('%-12s %10s %10s %10s %10s' % (
+    'dice', 'roll us', 'alias us', 'many us', 'alias us'))
+  rng = random.Random(0)
+  for expr in ALIAS:
+    dice = Dice(expr)
+    t = time.perf_counter()
+    dice.alias()
+    build = 1e3 * (time.perf_counter() - t)
+    one = timeit(dice.compile(rng))
+    alias = timeit(dice.compile(rng, alias=True))
+    t = time.perf_counter()
+    dice.roll_many(ROLLS, rng)
+    many = 1e6 * (time.perf_counter() - t) / ROLLS
+    t = time.perf_counter()
+    dice.roll_many(ROLLS, rng, alias=True)
+    fast = 1e6 * (time.perf_counter() - t) / ROLLS
+    print('%-12s %10.3f %10.3f %10.3f %10.3f   (table %.1f ms)' % (
+      expr, one, alias, many, fast, build))
+
+# exact vs FFT vs normal vs Edgeworth distributions as the number of totals
+# grows; the exact timings clear every cache first so nothing is reused
+def bench_crossover():
+
+  print('%-8s %6s %10s %10s %10s %10s' % (
+    'dice', 'span', 'exact ms', 'fft ms', 'normal ms', 'edgew ms'))
+  for (die, num) in SPANS:
+    expr = '%s%s' % (num, die)
+    dice = Dice(expr)
+    times = []
+    for method in ('exact', 'fft', 'normal', 'edgeworth'):
+      t = time.perf_counter()
+      for i in range(5):
+        dice_mod._WEIGHTS.clear()
+        object.__setattr__(dice, '_weights', None)
+        dice.distribution(method=method)
+      times.append(1e3 * (time.perf_counter() - t) / 5)
+    span = dice.max() - dice.min() + 1
+    print('%-8s %6s %10.3f %10.3f %10.3f %10.3f' % ((expr, span) + tuple(times)))
+  print('\nFFT_SPAN = %s' % dice_mod.FFT_SPAN)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
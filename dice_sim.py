@@ -1,38 +1,117 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # encoding: utf8
 #
+# usage: ./dice_sim.py [dice] [-r N ...] [-d N] [-n SIMS] [-w WORKERS]
+#   [-s SEED] [--width PCT] [-x] [-c]
+#
 # examples:
 #
-# DICE = '1d20'; '4d10+5'; '2d53+7d9+-50'
+# dice = 1d20; 4d10+5; 2d53+7d9+-50
 # the dice that will be rolled
 #
-# REROLL = [1]; [1,2]; [1,6]
+# -r 1; -r 1 -r 2; -r 1 -r 6
 # reroll the listed values once
 #
-# DROP = 1; 2; 3
-# drop the n lowest rolls
+# -d 1; 2; -1
+# drop the n lowest rolls (or highest if negative)
 #
-# SIMS = 100; 1000; 1000000
+# -n 100; 1000; 1000000
 # number of simulations to run
+#
+# -w 1; 4
+# number of worker processes (default one per cpu)
+#
+# --width 0.1
+# stop early once every bucket's 95% confidence interval is narrower than
+# this many percentage points
+#
+# -x
+# compute the distribution exactly instead of simulating
+#
+# -c
+# compute it exactly, then simulate and print the error of the estimate
 
-import random,time
+import os,random,time
+from argparse import ArgumentParser
+from array import array
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+
+from dice import Dice
 
 DICE = '6d4+12'
-REROLL = []
-DROP = 0
 SIMS = 1000000
+SHARD = 100000
+Z = 1.96
 
-def main():
+def main(args=None):
 
-  random.seed(time.time())
+  args = get_args(args)
   t = time.time()
-  result = simulate()
-  t = time.time()-t
-  cum_sum = list(cumsum(result.values()[::-1]))[::-1]
-  print '%s R(%s) D%s took %s sec\n' % (DICE,','.join(map(str,REROLL)),DROP,t)
-  print '\n'.join(['%3d = %7.4f %6.2f %s' % (t,p,c,'█'*int(round(2*p))) for ((t,p),c) in zip(result.items(),cum_sum)])
-  print '\nAverage: %s' % (reduce(lambda a,b: a+b[0]*b[1],result.items(),0)/100.0)
+  if args['exact'] or args['compare']:
+    result = exact(args['dice'],args['reroll'],args['drop'])
+  else:
+    result = simulate(**sim_args(args))
+  show(args,result,time.time()-t)
+  if args['compare']:
+    t = time.time()
+    sim = simulate(**sim_args(args))
+    t = time.time()-t
+    print('')
+    show(args,sim,t)
+    compare(result,sim)
+
+# @param args (list) [None] list of arguments to parse (None for sys.argv)
+# @return (dict)
+def get_args(args=None):
+
+  ap = ArgumentParser()
+  add = ap.add_argument
+
+  add('dice', nargs='?', default=DICE,
+    help='Dice to roll e.g. 4d6+2 (default %s)' % DICE)
+
+  add('-r', '--reroll', type=int, action='append', default=[],
+    help='Reroll this value once (repeatable)')
+  add('-d', '--drop', type=int, default=0,
+    help='Drop the n lowest rolls of each term (highest if negative)')
+  add('-n', '--sims', type=int, default=SIMS,
+    help='Maximum number of simulations (default %s)' % SIMS)
+  add('-w', '--workers', type=int, default=os.cpu_count() or 1,
+    help='Number of worker processes (default one per cpu)')
+  add('-s', '--seed', type=int,
+    help='Seed for reproducible runs')
+  add('--width', type=float,
+    help='Stop once every 95%% confidence interval is narrower than this')
+  add('-x', '--exact', action='store_true',
+    help='Compute the distribution exactly instead of simulating')
+  add('-c', '--compare', action='store_true',
+    help='Compute exactly and compare against a simulation')
+
+  return vars(ap.parse_args(args))
+
+def sim_args(args):
+
+  keys = ('dice','reroll','drop','sims','workers','seed','width')
+  return {k:args[k] for k in keys}
+
+def show(args,result,t):
+
+  cum_sum = list(cumsum(list(result.values())[::-1]))[::-1]
+  print('%s R(%s) D%s took %s sec\n' % (args['dice'],','.join(map(str,args['reroll'])),args['drop'],t))
+  print('\n'.join(['%3d = %7.4f %6.2f %s' % (t,p,c,'█'*int(round(2*p))) for ((t,p),c) in zip(result.items(),cum_sum)]))
+  print('\nAverage: %s' % (reduce(lambda a,b: a+b[0]*b[1],result.items(),0)/100.0))
+  if hasattr(result,'sims'):
+    print('Sims: %s' % result.sims)
+
+def compare(exact,sim):
+
+  diffs = [sim.get(t,0)-p for (t,p) in exact.items()]
+  worst = max(range(len(diffs)),key=lambda i: abs(diffs[i]))
+  print('\nMonte Carlo vs exact (%s sims):' % sim.sims)
+  print('  max error   %7.4f at %s' % (abs(diffs[worst]),list(exact)[worst]))
+  print('  total error %7.4f' % (sum(map(abs,diffs))/2))
 
 def cumsum(lis):
 
@@ -41,44 +120,145 @@ def cumsum(lis):
       total += x
       yield total
 
-def simulate():
+# @param dice (str) e.g. 4d6+2
+# @return (list of tuple,int) one (num,sides) tuple per die term or int bonus
+def parse(dice):
 
-  fields = DICE.split('+')
   ops = []
-  for field in fields:
+  for field in dice.split('+'):
     if 'd' in field:
       (a,b) = field.split('d')
       ops.append((int(a),int(b)))
     else:
       ops.append(int(field))
+  return ops
+
+# the same dice as a Dice pool expression e.g. 6d4r1dl1+12, whose exact
+# distribution dice.py builds from order statistics instead of sampling
+def expression(dice,reroll=(),drop=0):
+
+  terms = []
+  for field in dice.split('+'):
+    if 'd' not in field:
+      terms.append(field)
+      continue
+    (a,b) = field.split('d')
+    if int(a) <= abs(drop):
+      continue
+    term = field+''.join('r%s' % r for r in reroll)
+    if drop:
+      term += '%s%s' % ('dh' if drop<0 else 'dl',abs(drop))
+    terms.append(term)
+  return '+'.join(terms) or '0'
+
+def exact(dice,reroll=(),drop=0):
+
+  # never let distribution() pick an approximation for big expressions
+  dist = Dice(expression(dice,reroll,drop)).distribution(method='exact')
+  return OrderedDict([(a,100.0*b) for (a,b) in dist.items()])
+
+# @return (int,int) lowest and highest possible totals
+def bounds(ops,drop):
 
   mi = 0
   ma = 0
   for o in ops:
     if isinstance(o,tuple):
-      mi += o[0]-abs(DROP)
-      ma += (o[0]-abs(DROP))*o[1]
+      kept = max(o[0]-abs(drop),0)
+      mi += kept
+      ma += kept*o[1]
     else:
       mi += o
       ma += o
-  result = OrderedDict([(x,0) for x in range(mi,ma+1)])
+  return (mi,ma)
 
-  for i in xrange(0,SIMS):
-    total = 0
-    for o in ops:
-      if isinstance(o,tuple):
-        rolls = []
-        for n in range(0,o[0]):
-          roll = random.randint(1,o[1])
-          if REROLL and roll in REROLL:
-            roll = random.randint(1,o[1])
-          rolls.append(roll)
-        total += sum(sorted(rolls,reverse=(DROP<0))[abs(DROP):])
-      else:
-        total += o
-    result[total] += 1
-
-  return OrderedDict([(a,100.0*b/SIMS) for (a,b) in result.items()])
+# run one shard of the simulation in a worker process
+# @param ops (list) from parse()
+# @param reroll (list of int)
+# @param drop (int)
+# @param sims (int) number of simulations in this shard
+# @param seed (int) seed for this shard's own random stream
+# @return (array of int) count of each total, starting at the lowest
+def shard(ops,reroll,drop,sims,seed):
+
+  rng = random.Random(seed)
+  randrange = rng.randrange
+  reroll = frozenset(reroll)
+  (mi,ma) = bounds(ops,drop)
+  counts = array('q',[0])*(ma-mi+1)
+  (start,rev) = (abs(drop),drop<0)
+  bonus = sum(o for o in ops if not isinstance(o,tuple))-mi
+  ops = [o for o in ops if isinstance(o,tuple)]
+
+  for i in range(sims):
+    total = bonus
+    for (num,sides) in ops:
+      rolls = [randrange(sides)+1 for n in range(num)]
+      if reroll:
+        rolls = [randrange(sides)+1 if r in reroll else r for r in rolls]
+      if drop:
+        rolls = sorted(rolls,reverse=rev)[start:]
+      total += sum(rolls)
+    counts[total] += 1
+
+  return counts
+
+# @param counts (array of int) merged shard counts
+# @param n (int) total simulations so far
+# @return (float) widest 95% Wilson confidence interval over all buckets, in
+#   percentage points
+def widest(counts,n):
+
+  z2 = Z*Z
+  return max(
+    200*Z*((c*(n-c)/n+z2/4)**0.5)/(n+z2)
+    for c in counts
+  )
+
+# @param dice (str)
+# @param reroll (list of int) [()]
+# @param drop (int) [0]
+# @param sims (int) [SIMS] simulation budget
+# @param workers (int) [1] number of processes
+# @param seed (int) [None] master seed; each shard gets its own derived seed
+# @param width (float) [None] stop early once every bucket's confidence
+#   interval is narrower than this many percentage points
+# @return (OrderedDict) total => percent, with a sims attribute
+def simulate(dice=DICE,reroll=(),drop=0,sims=SIMS,workers=1,seed=None,
+    width=None):
+
+  ops = parse(dice)
+  (mi,ma) = bounds(ops,drop)
+  seeds = random.Random(seed)
+  counts = array('q',[0])*(ma-mi+1)
+  done = 0
+
+  pool = ProcessPoolExecutor(workers) if workers>1 else None
+  try:
+    while done<sims:
+      size = min(SHARD,-(-(sims-done)//workers))
+      jobs = []
+      while len(jobs)<workers and done<sims:
+        n = min(size,sims-done)
+        job = (ops,reroll,drop,n,seeds.getrandbits(64))
+        jobs.append(pool.submit(shard,*job) if pool else shard(*job))
+        done += n
+      for job in jobs:
+        part = job.result() if pool else job
+        for (i,c) in enumerate(part):
+          counts[i] += c
+      if width and widest(counts,done)<width:
+        break
+  finally:
+    if pool:
+      pool.shutdown()
+
+  result = Result([(mi+i,100.0*c/done) for (i,c) in enumerate(counts)])
+  result.sims = done
+  return result
+
+class Result(OrderedDict):
+  pass
 
 if __name__ == '__main__':
   main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+from fractions import Fraction
+from itertools import product
+
+from dnd.dice import EXPLODE_LIMIT, Dice
+
+def test_pools_differing_in_keep_sort():
+  assert str(Dice('4d6r1+4d6r1kh3')) == '4d6r1+4d6r1kh3'
+
+def test_noop_pool_keeps_modifier():
+  for s in ('1d6-1d6kh1', '1d20+1d20kh1', '4d6dl0'):
+    d = Dice(s)
+    assert Dice(str(d)) is d
+  assert Dice('1d20+1d20kh1').key != Dice('2d20').key
+
+def test_zero_sides():
+  for s in ('d0', '2d0kh1'):
+    try:
+      Dice(s)
+    except ValueError:
+      continue
+    assert False, s
+
+def test_hash_uses_expression():
+  memo = {Dice('2d6'): 1}
+  assert Dice('7') not in memo
+  assert Dice('1d12+1') not in memo
+  assert memo[Dice('2d6')] == 1
+  assert Dice('7') == 7 and Dice('2d6') != 7
+
+def test_order_uses_average():
+  assert Dice('2d6') <= Dice('7') <= Dice('2d6')
+  assert not Dice('2d6') < Dice('7')
+  assert sorted([12, Dice('1d5'), Dice('3d5+10'), 7]) == [
+      Dice('1d5'), 7, 12, Dice('3d5+10')]
+
+ROUND_TRIP = (
+  '1d6-1d6kh1', '1d20+1d20kh1', '2d6kh2+1d4', '4d6dl1', '4d6kh3-4d6kl3',
+  '2d20kl1+5', '1d20r1', '1d20r1r2-1d20', '1d6!', '2d6!kh1-1d6', '4d6r1dl1',
+  '4d6r1+4d6r1kh3', '3d6-1d6kh1+2d6!',
+)
+
+def test_round_trip():
+  for s in ROUND_TRIP:
+    d = Dice(s)
+    assert Dice(str(d)).weights() == d.weights(), s
+
+def test_caches_tell_strings_apart():
+  d = Dice('1d6-1d6kh1')
+  assert abs(d.p_at_least(1) - 15 / 36) < 1e-12
+  assert abs(d.p_greater('0') - 15 / 36) < 1e-12
+  assert d.alias() is not Dice('0').alias()
+
+def test_distribution_ignores_cache():
+  d = Dice('3d6!+1d300')
+  before = d.distribution()
+  d.weights()
+  assert d.distribution() == before
+
+def test_big_statistics_match_exact():
+  d = Dice('60d20')
+  for x in (100, 600, 650, 1100):
+    assert abs(d.cdf(x) - d.cdf(x, exact=True)) < 1e-9
+    assert abs(d.p_at_least(x) - d.p_at_least(x, exact=True)) < 1e-9
+  other = Dice('59d20+3')
+  assert abs(d.p_greater(other) - d.p_greater(other, exact=True)) < 1e-9
+  assert abs(d.p_tie(other) - d.p_tie(other, exact=True)) < 1e-9
+  for q in (0.01, 0.3, 0.5, 0.99):
+    assert d.quantile(q) == d.quantile(q, exact=True)
+  assert abs(d.stddev() - d.stddev(exact=True)) < 1e-9
+
+def test_normal_within_error_bound():
+  for s in ('3d6', '4d6kh3', '5d10!', '1d20r1+2d4', '100d6-30d4'):
+    d = Dice(s)
+    exact = d.distribution(method='exact')
+    approx = d.distribution(method='normal')
+    (a, b) = (0, 0)
+    for x in range(d.min(), d.max() + 1):
+      a += exact.get(x, 0)
+      b += approx.get(x, 0)
+      assert abs(a - b) <= d.approx_error(), (s, x)
+
+def test_parse_rejects_pools():
+  assert Dice.parse('2d6+1d4-3') == ({6: 2, 4: 1}, -3)
+  for s in ('4d6kh3+2', '1d6!', '1d20r1'):
+    try:
+      Dice.parse(s)
+    except ValueError:
+      continue
+    assert False, s
+
+# @param sides (int)
+# @param reroll (tuple of int) faces rerolled once on the first roll
+# @param explode (bool)
+# @param depth (int) [0] how many times this die already exploded
+# @return (dict) total:Fraction for one die, by listing every roll
+def brute_die(sides, reroll=(), explode=False, depth=0):
+
+  out = {}
+  p = Fraction(1, sides)
+  for v in range(1, sides + 1):
+    if v in reroll and depth == 0:
+      rolls = [(w, p / sides) for w in range(1, sides + 1)]
+    else:
+      rolls = [(v, p)]
+    for (w, q) in rolls:
+      if explode and w == sides and depth < EXPLODE_LIMIT:
+        for (x, r) in brute_die(sides, (), True, depth + 1).items():
+          out[sides + x] = out.get(sides + x, 0) + q * r
+      else:
+        out[w] = out.get(w, 0) + q
+  return out
+
+# @param d (Dice)
+# @return (dict) total:Fraction by listing every combination of dice
+def brute(d):
+
+  terms = [(brute_die(s), abs(n), 1, None, True, n < 0)
+      for (s, n) in d.dice.items()]
+  terms += [(brute_die(p.sides, p.reroll, p.explode), p.num, abs(n), p.keep,
+      p.high, n < 0) for (p, n) in d.pools.items()]
+
+  dist = {d.bonus: Fraction(1)}
+  for (die, num, copies, keep, high, neg) in terms:
+    # one pool, or all the plain dice of one size
+    group = {}
+    for rolls in product(die.items(), repeat=num):
+      values = sorted((v for (v, _) in rolls), reverse=high)
+      total = sum(values[:keep or num])
+      p = Fraction(1)
+      for (_, q) in rolls:
+        p *= q
+      group[total] = group.get(total, 0) + p
+    for i in range(copies):
+      new = {}
+      for (a, p) in dist.items():
+        for (b, q) in group.items():
+          t = a - b if neg else a + b
+          new[t] = new.get(t, 0) + p * q
+      dist = new
+  return {t: p for (t, p) in dist.items() if p}
+
+BRUTE = (
+  '1d6', '2d6+3', '3d4-1d6', '1d20-5', '4d6kh3', '4d6dl1', '3d6kl2+1',
+  '2d20kh1-2d20kl1', '1d6r1', '2d8r1r2', '1d4!', '2d4!+1d6', '3d4!kh2',
+  '2d6r1dl1', '1d6-1d6kh1', '7',
+)
+
+def test_distribution_brute_force():
+  for s in BRUTE:
+    d = Dice(s)
+    assert dict(d.distribution(exact=True)) == brute(d), s
+
+def test_cdf_quantile_brute_force():
+  for s in BRUTE:
+    d = Dice(s)
+    dist = sorted(brute(d).items())
+    cum = 0
+    for (t, p) in dist:
+      assert abs(d.cdf(t - 1) - float(cum)) < 1e-12, (s, t)
+      cum += p
+      assert abs(d.cdf(t) - float(cum)) < 1e-12, (s, t)
+      assert abs(d.p_at_least(t) - float(1 - cum + p)) < 1e-12, (s, t)
+    for q in (0, 0.1, 0.25, 0.5, 0.75, 0.9, 1):
+      cum = 0
+      for (t, p) in dist:
+        cum += p
+        if cum >= Fraction(str(q)):
+          break
+      assert d.quantile(q) == t, (s, q)
+
+def test_comparisons_brute_force():
+  for (a, b) in (('1d20+5', '1d20+3'), ('4d6kh3', '3d6'), ('2d4!', '1d8r1')):
+    (da, db) = (brute(Dice(a)), brute(Dice(b)))
+    greater = sum(p * q for (x, p) in da.items() for (y, q) in db.items()
+        if x > y)
+    tie = sum(p * q for (x, p) in da.items() for (y, q) in db.items()
+        if x == y)
+    assert abs(Dice(a).p_greater(b) - float(greater)) < 1e-12
+    assert abs(Dice(a).p_tie(b) - float(tie)) < 1e-12